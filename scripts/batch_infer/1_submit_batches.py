@@ -8,12 +8,19 @@ Usage:
         --prompt /path/to/prompt.txt \
         --env_file .env \
         --output_dir ./batches
+
+    # Keep in-flight batches within the deployment's enqueued-token quota
+    python 1_submit_batches.py ... --token_quota 5000000
 """
 import argparse
 import logging
 import os
+import sys
 from dotenv import load_dotenv
-from batch_processor import MultimodalBatchProcessor, AzureBatchManager
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))  # profiling.py
+from batch_processor import MultimodalBatchProcessor, AzureBatchManager, TokenQuotaScheduler, quota_batch_token_limit
+from near_duplicates import load_reuse_map
+from profiling import add_profile_args, run_profiled
 
 
 def setup_logging():
@@ -43,6 +50,19 @@ def main():
     parser.add_argument('--env_file', required=True, help='Path to .env file with Azure credentials')
     parser.add_argument('--output_dir', default='./batches', help='Directory for batch files')
     parser.add_argument('--tracking_file', default='./batch_tracking.txt', help='File to track batch IDs')
+    parser.add_argument('--instruction_in_system', action='store_true',
+                        help='Put the static instruction in a leading system message (enables prompt-prefix caching)')
+    parser.add_argument('--token_quota', type=int,
+                        help='Enqueued-token quota of the deployment; batches are held back until they fit')
+    parser.add_argument('--quota_state', default='./quota_state.json',
+                        help='State file of the quota scheduler, used to resume an interrupted submission')
+    parser.add_argument('--poll_interval', type=float, default=60,
+                        help='Seconds between status checks while waiting for quota')
+    parser.add_argument('--max_submit_retries', type=int, default=3,
+                        help='With --token_quota: submission attempts per batch, counting quota rejections')
+    parser.add_argument('--near_duplicates',
+                        help='Report from near_duplicates.py; items that can reuse a representative\'s explanation are not sent')
+    add_profile_args(parser)
     
     args = parser.parse_args()
     setup_logging()
@@ -60,6 +80,11 @@ def main():
         logging.error(f"Environment file not found: {args.env_file}")
         return
     
+    skip_ids = set()
+    if args.near_duplicates:
+        skip_ids = {d for duplicates in load_reuse_map(args.near_duplicates).values() for d in duplicates}
+        logging.info(f"Skipping {len(skip_ids)} near-duplicate items (explanations are copied when merging)")
+    
     # Create output directory
     os.makedirs(args.output_dir, exist_ok=True)
     
@@ -72,7 +97,10 @@ def main():
     processor = MultimodalBatchProcessor(
         dataset_path=args.dataset,
         prompt_file=args.prompt,
-        output_dir=args.output_dir
+        output_dir=args.output_dir,
+        instruction_in_system=args.instruction_in_system,
+        batch_token_limit=quota_batch_token_limit(args.token_quota),
+        skip_ids=skip_ids
     )
     processor.create_batches(env_vars['deployment_name'])
     
@@ -85,7 +113,12 @@ def main():
         deployment_name=env_vars['deployment_name'],
         batch_tracking_file=args.tracking_file
     )
-    batch_manager.submit_all_batches(args.output_dir)
+    scheduler = TokenQuotaScheduler(args.token_quota, args.quota_state) if args.token_quota else None
+    gave_up = batch_manager.submit_all_batches(args.output_dir, scheduler=scheduler, poll_interval=args.poll_interval,
+                                               max_attempts=args.max_submit_retries)
+    if gave_up:
+        logging.error(f"{len(gave_up)} batches could not be submitted: {', '.join(gave_up)}")
+        return 1
     
     logging.info("✓ Batch submission complete!")
     logging.info(f"  Batch files: {args.output_dir}")
@@ -95,4 +128,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(run_profiled(main))
@@ -11,8 +11,11 @@ Usage:
 import argparse
 import logging
 import os
+import sys
 from dotenv import load_dotenv
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))  # profiling.py
 from batch_processor import AzureBatchManager
+from profiling import add_profile_args, run_profiled
 
 
 def setup_logging():
@@ -40,6 +43,7 @@ def main():
     parser.add_argument('--env_file', required=True, help='Path to .env file with Azure credentials')
     parser.add_argument('--tracking_file', default='./batch_tracking.txt', help='Batch tracking file')
     parser.add_argument('--output_dir', default='./results', help='Directory to save results')
+    add_profile_args(parser)
     
     args = parser.parse_args()
     setup_logging()
@@ -82,4 +86,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    run_profiled(main)
@@ -15,6 +15,10 @@ import argparse
 import json
 import logging
 import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))  # profiling.py
+from near_duplicates import copy_to_duplicates, load_reuse_map
+from profiling import add_profile_args, run_profiled, stage
 
 
 def setup_logging():
@@ -25,53 +29,83 @@ def setup_logging():
     )
 
 
+def log_token_usage(usage_totals):
+    """Log prompt/completion token totals and how many prompt tokens were served from the prompt cache."""
+    if not usage_totals['requests']:
+        return
+    prompt_tokens = usage_totals['prompt_tokens']
+    cached_tokens = usage_totals['cached_tokens']
+    cached_share = 100 * cached_tokens / prompt_tokens if prompt_tokens else 0.0
+    logging.info(f"Token usage over {usage_totals['requests']} responses: "
+                 f"prompt={prompt_tokens}, cached={cached_tokens} ({cached_share:.1f}% of prompt), "
+                 f"completion={usage_totals['completion_tokens']}")
+
+
+def new_usage_totals():
+    return {'requests': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0}
+
+
+def load_result_file(file_path, results, usage_totals):
+    """Parse one batch output file into results (custom_id -> explanation) and add up its token usage."""
+    with open(file_path, 'r') as f:
+        for line in f:
+            try:
+                result = json.loads(line.strip())
+                custom_id = result['custom_id']
+                
+                # Extract the response content (should be JSON with explanation field)
+                if 'response' in result and 'body' in result['response']:
+                    usage = result['response']['body'].get('usage') or {}
+                    if usage:
+                        usage_totals['requests'] += 1
+                        usage_totals['prompt_tokens'] += usage.get('prompt_tokens', 0)
+                        usage_totals['completion_tokens'] += usage.get('completion_tokens', 0)
+                        details = usage.get('prompt_tokens_details') or {}
+                        usage_totals['cached_tokens'] += details.get('cached_tokens', 0)
+                    
+                    content = result['response']['body']['choices'][0]['message']['content']
+                    
+                    # Try to parse the JSON response
+                    try:
+                        # Clean up markdown code blocks if present
+                        if content.strip().startswith('```'):
+                            # Remove ```json or ``` at start and ``` at end
+                            lines = content.strip().split('\n')
+                            content = '\n'.join(lines[1:-1])
+                        
+                        parsed_content = json.loads(content.strip())
+                        explanation = parsed_content.get('explanation', content)
+                    except json.JSONDecodeError:
+                        # If not valid JSON, use the raw content
+                        logging.warning(f"Could not parse JSON for {custom_id}, using raw content")
+                        explanation = content
+                    
+                    results[custom_id] = explanation
+                    
+            except Exception as e:
+                logging.warning(f"Error parsing result: {e}")
+                continue
+
+
 def load_batch_results(results_dir):
     """Load all batch result files and extract generated explanations."""
     results = {}
+    usage_totals = new_usage_totals()
     
     result_files = [f for f in os.listdir(results_dir) if f.startswith('batch_output_') and f.endswith('.jsonl')]
     
     logging.info(f"Found {len(result_files)} result files")
     
     for result_file in result_files:
-        file_path = os.path.join(results_dir, result_file)
-        
-        with open(file_path, 'r') as f:
-            for line in f:
-                try:
-                    result = json.loads(line.strip())
-                    custom_id = result['custom_id']
-                    
-                    # Extract the response content (should be JSON with explanation field)
-                    if 'response' in result and 'body' in result['response']:
-                        content = result['response']['body']['choices'][0]['message']['content']
-                        
-                        # Try to parse the JSON response
-                        try:
-                            # Clean up markdown code blocks if present
-                            if content.strip().startswith('```'):
-                                # Remove ```json or ``` at start and ``` at end
-                                lines = content.strip().split('\n')
-                                content = '\n'.join(lines[1:-1])
-                            
-                            parsed_content = json.loads(content.strip())
-                            explanation = parsed_content.get('explanation', content)
-                        except json.JSONDecodeError:
-                            # If not valid JSON, use the raw content
-                            logging.warning(f"Could not parse JSON for {custom_id}, using raw content")
-                            explanation = content
-                        
-                        results[custom_id] = explanation
-                        
-                except Exception as e:
-                    logging.warning(f"Error parsing result: {e}")
-                    continue
+        with stage("parse"):
+            load_result_file(os.path.join(results_dir, result_file), results, usage_totals)
     
     logging.info(f"Loaded {len(results)} generated explanations")
+    log_token_usage(usage_totals)
     return results
 
 
-def merge_with_dataset(dataset_path, results, output_path):
+def merge_with_dataset(dataset_path, results, output_path, warn_missing=True):
     """Merge generated explanations with original dataset."""
     merged_count = 0
     total_count = 0
@@ -91,7 +125,8 @@ def merge_with_dataset(dataset_path, results, output_path):
                     merged_count += 1
                 else:
                     item['generated_explanation'] = None
-                    logging.warning(f"No explanation found for item: {item_id}")
+                    if warn_missing:
+                        logging.warning(f"No explanation found for item: {item_id}")
                 
                 out_f.write(json.dumps(item, ensure_ascii=False) + '\n')
     
@@ -104,6 +139,9 @@ def main():
     parser.add_argument('--dataset', required=True, help='Path to original JSONL dataset')
     parser.add_argument('--results_dir', default='./results', help='Directory with batch results')
     parser.add_argument('--output', default='./dataset_with_explanations.jsonl', help='Output JSONL file')
+    parser.add_argument('--near_duplicates',
+                        help='Report from near_duplicates.py; copies each representative\'s explanation to its duplicates')
+    add_profile_args(parser)
     
     args = parser.parse_args()
     setup_logging()
@@ -125,9 +163,14 @@ def main():
         logging.error("No results found!")
         return
     
+    if args.near_duplicates:
+        copied = copy_to_duplicates(results, load_reuse_map(args.near_duplicates))
+        logging.info(f"Copied explanations to {copied} near-duplicate items")
+    
     # Merge with dataset
     logging.info("Merging generated explanations with original dataset...")
-    merged_count, total_count = merge_with_dataset(args.dataset, results, args.output)
+    with stage("merge + write"):
+        merged_count, total_count = merge_with_dataset(args.dataset, results, args.output)
     
     logging.info(f"✓ Merge complete!")
     logging.info(f"  Output file: {args.output}")
@@ -138,4 +181,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    run_profiled(main)
@@ -2,9 +2,66 @@
 Core batch processing library for multimodal inference.
 """
 import base64
+import hashlib
 import json
+import math
 import os
+import threading
+import time
 from openai import AzureOpenAI
+try:
+    from profiling import stage
+except ImportError:  # scripts/src/ is put on sys.path by the entry-point scripts
+    from contextlib import nullcontext
+
+    def stage(name):
+        return nullcontext()
+
+# Worst case for one image: high detail with up to eight 512px tiles (85 + 8 * 170 tokens)
+IMAGE_TOKEN_ESTIMATE = 1445
+# Batch files are capped below the quota because the token estimate is approximate
+QUOTA_SAFETY_FRACTION = 0.9
+FINISHED_STATUSES = ('completed', 'failed', 'expired', 'cancelled', 'not_found')
+
+
+def item_id(item):
+    """custom_id of an item in the batch files: its 'id' field, otherwise the image basename."""
+    return item.get('id', os.path.basename(item['img_path']))
+
+
+def file_sha256(path):
+    """Hex digest of a file's content, used to recognise batch files that were already submitted."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def estimate_request_tokens(payload):
+    """Rough prompt-token count of one batch request: ~4 UTF-8 bytes per text token plus a fixed cost per image."""
+    tokens = 0
+    for message in payload['body']['messages']:
+        content = message['content']
+        parts = [{'type': 'text', 'text': content}] if isinstance(content, str) else content
+        for part in parts:
+            if part.get('type') == 'image_url':
+                tokens += IMAGE_TOKEN_ESTIMATE
+            elif part.get('type') == 'text':
+                tokens += math.ceil(len(part['text'].encode('utf-8')) / 4)
+        tokens += 4  # role and message framing
+    return tokens
+
+
+def quota_batch_token_limit(token_quota):
+    """Estimated-token cap for batch files submitted under token_quota, or None without a quota."""
+    return int(token_quota * QUOTA_SAFETY_FRACTION) if token_quota else None
+
+
+def estimate_batch_tokens(batch_file_path):
+    """Estimated prompt tokens of all requests in a batch file."""
+    with open(batch_file_path, 'r') as f:
+        return sum(estimate_request_tokens(json.loads(line)) for line in f if line.strip())
 
 
 class MultimodalBatchProcessor:
@@ -15,6 +72,9 @@ class MultimodalBatchProcessor:
         output_dir,
         batch_file_size_limit=180 * 1024 * 1024,
         image_size_limit=10 * 1024 * 1024,
+        instruction_in_system=False,
+        batch_token_limit=None,
+        skip_ids=None,
     ):
         """
         Initialize the batch processor.
@@ -25,12 +85,22 @@ class MultimodalBatchProcessor:
             output_dir (str): Directory where batch files will be saved
             batch_file_size_limit (int): Maximum size of batch file in bytes (default: 180MB)
             image_size_limit (int): Maximum size of individual image in bytes (default: 10MB)
+            instruction_in_system (bool): Send the instruction as an identical leading system
+                message and put the per-item class_label and text last, so the provider
+                can reuse its prompt-prefix cache across requests (default: False)
+            batch_token_limit (int): Maximum estimated prompt tokens per batch file, e.g. the
+                deployment's enqueued-token quota (default: None, no limit)
+            skip_ids (set): Item ids not to send, e.g. near-duplicates that reuse the
+                explanation of a representative item (default: None)
         """
         self.dataset_path = dataset_path
         self.prompt_file = prompt_file
         self.output_dir = output_dir
         self.batch_file_size_limit = batch_file_size_limit
         self.image_size_limit = image_size_limit
+        self.instruction_in_system = instruction_in_system
+        self.batch_token_limit = batch_token_limit
+        self.skip_ids = set(skip_ids or ())
         
         # Load instruction prompt
         with open(self.prompt_file, 'r', encoding='utf-8') as f:
@@ -42,11 +112,11 @@ class MultimodalBatchProcessor:
     def load_dataset(self):
         """Load dataset from JSONL file."""
         data = []
-        with open(self.dataset_path, 'r', encoding='utf-8') as f:
+        with stage("dataset load"), open(self.dataset_path, 'r', encoding='utf-8') as f:
             for line in f:
                 item = json.loads(line.strip())
                 # Validate required fields
-                if 'img_path' in item:
+                if 'img_path' in item and item_id(item) not in self.skip_ids:
                     data.append(item)
         return data
 
@@ -55,7 +125,7 @@ class MultimodalBatchProcessor:
         if not os.path.exists(image_path):
             raise FileNotFoundError(f"Image not found: {image_path}")
         
-        with open(image_path, 'rb') as image_file:
+        with stage("image encode"), open(image_path, 'rb') as image_file:
             encoded = base64.b64encode(image_file.read()).decode('utf-8')
         return encoded
 
@@ -68,21 +138,47 @@ class MultimodalBatchProcessor:
         Create API request payload for a single item.
         
         Format: <image> {instruction} Text extracted: {text}
+        With instruction_in_system:
+            system: {instruction}
+            user: <image> Class label: {class_label} Text extracted: {text}
         """
         img_path = item['img_path']
         text = item.get('text', item.get('extracted_text', ''))
         class_label = item.get('class_label', '')
         
-        # Build the user message - substitute class_label into instruction if it contains {}
-        instruction = self.instruction.format(class_label) if '{}' in self.instruction else self.instruction
-        user_text = f"{instruction}\nText extracted: {text}"
+        if self.instruction_in_system:
+            # Keep the system message byte-identical for every item; the label moves to the user message
+            instruction = self.instruction.replace('{}', 'the class label given with the image')
+            user_text = f"Class label: {class_label}\nText extracted: {text}"
+        else:
+            # Build the user message - substitute class_label into instruction if it contains {}
+            instruction = self.instruction.replace('{}', class_label)
+            user_text = f"{instruction}\nText extracted: {text}"
         
         # Encode image
         base64_image = self.encode_image_base64(img_path)
         image_url = f"data:image/jpeg;base64,{base64_image}"
         
         # Use 'id' field from dataset if available, otherwise fall back to image basename
-        custom_id = item.get('id', os.path.basename(img_path))
+        custom_id = item_id(item)
+        
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": image_url}
+                    },
+                    {
+                        "type": "text",
+                        "text": user_text
+                    }
+                ]
+            }
+        ]
+        if self.instruction_in_system:
+            messages.insert(0, {"role": "system", "content": instruction})
         
         # Create payload
         payload = {
@@ -91,21 +187,7 @@ class MultimodalBatchProcessor:
             "url": "/chat/completions",
             "body": {
                 "model": deployment_name,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": image_url}
-                            },
-                            {
-                                "type": "text",
-                                "text": user_text
-                            }
-                        ]
-                    }
-                ],
+                "messages": messages,
                 "max_tokens": 4096,
                 "temperature": 0.0
             }
@@ -113,16 +195,24 @@ class MultimodalBatchProcessor:
         
         return payload
 
-    def create_batches(self, deployment_name):
-        """Create batch files from dataset."""
+    def iter_batches(self, deployment_name, start_item=0, start_counter=1):
+        """
+        Build batch files one at a time.
+
+        Yields (batch_counter, batch_file_path, next_item, num_items) as soon as each
+        batch file is saved. next_item is the dataset position right after the batch,
+        so building can be resumed from there with start_item.
+        """
         dataset = self.load_dataset()
         current_batch = []
         current_batch_size = 0
-        batch_counter = 1
+        current_batch_tokens = 0
+        batch_counter = start_counter
         
-        print(f"Processing {len(dataset)} items...")
+        print(f"Processing {len(dataset) - start_item} items...")
         
-        for item in dataset:
+        for index in range(start_item, len(dataset)):
+            item = dataset[index]
             img_path = item['img_path']
             
             # Check if image exists and is within size limit
@@ -137,39 +227,137 @@ class MultimodalBatchProcessor:
             try:
                 # Create request payload
                 payload = self.create_request_payload(item, deployment_name)
-                payload_size = len(json.dumps(payload).encode('utf-8'))
-                
-                # Check if we need to start a new batch
-                if current_batch_size + payload_size > self.batch_file_size_limit:
-                    self.save_batch(current_batch, batch_counter)
-                    current_batch = []
-                    current_batch_size = 0
-                    batch_counter += 1
-                
-                current_batch.append(payload)
-                current_batch_size += payload_size
-                
+                with stage("serialize"):
+                    payload_size = len(json.dumps(payload).encode('utf-8'))
+                payload_tokens = estimate_request_tokens(payload)
             except Exception as e:
                 print(f"Error processing {img_path}: {e}")
                 continue
+            
+            # Check if we need to start a new batch
+            over_size = current_batch_size + payload_size > self.batch_file_size_limit
+            over_tokens = (self.batch_token_limit is not None
+                           and current_batch_tokens + payload_tokens > self.batch_token_limit)
+            if current_batch and (over_size or over_tokens):
+                batch_file_path = self.save_batch(current_batch, batch_counter)
+                yield batch_counter, batch_file_path, index, len(current_batch)
+                current_batch = []
+                current_batch_size = 0
+                current_batch_tokens = 0
+                batch_counter += 1
+            
+            current_batch.append(payload)
+            current_batch_size += payload_size
+            current_batch_tokens += payload_tokens
         
         # Save remaining items
         if current_batch:
-            self.save_batch(current_batch, batch_counter)
+            batch_file_path = self.save_batch(current_batch, batch_counter)
+            yield batch_counter, batch_file_path, len(dataset), len(current_batch)
+
+    def create_batches(self, deployment_name):
+        """Create batch files from dataset."""
+        batch_count = 0
+        for batch_count, _, _, _ in self.iter_batches(deployment_name):
+            pass
         
-        print(f"Batch creation complete. {batch_counter} batch files created.")
+        print(f"Batch creation complete. {batch_count} batch files created.")
 
     def save_batch(self, batch, batch_counter):
-        """Save batch to JSONL file."""
+        """Save batch to JSONL file and return its path."""
         batch_file_path = os.path.join(self.output_dir, f"batch_{batch_counter}.jsonl")
-        with open(batch_file_path, 'w') as f:
+        with stage("serialize"), open(batch_file_path, 'w') as f:
             for item in batch:
                 f.write(json.dumps(item) + '\n')
         print(f"Saved batch {batch_counter} with {len(batch)} items to {batch_file_path}")
+        return batch_file_path
+
+
+class TokenQuotaScheduler:
+    """
+    Keep the estimated prompt tokens of in-flight batches within the deployment's
+    enqueued-token quota.
+
+    A batch is admitted only if it fits next to the batches already in flight (a
+    batch larger than the whole quota is admitted alone) and its tokens are released
+    when it finishes. In-flight and completed batches are saved to state_file, keyed
+    by the sha256 of the batch file content, so a restarted run keeps counting
+    batches submitted before the restart and recognises them even though batch
+    files are rewritten under the same names.
+    """
+
+    def __init__(self, token_quota, state_file):
+        """
+        Args:
+            token_quota (int): Enqueued-token quota of the deployment
+            state_file (str): JSON file persisting the scheduler state
+        """
+        self.token_quota = token_quota
+        self.state_file = state_file
+        self.condition = threading.Condition()
+        self.in_flight = {}
+        self.finished_hashes = []
+        self.releases = 0  # number of releases in this process, to wake batches waiting for freed quota
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+            self.in_flight = state['in_flight']
+            self.finished_hashes = state.get('finished_hashes', [])
+
+    def _save(self):
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'token_quota': self.token_quota, 'in_flight': self.in_flight,
+                       'finished_hashes': self.finished_hashes}, f, indent=2)
+        os.replace(tmp_path, self.state_file)
+
+    def _fits(self, tokens):
+        return not self.in_flight or self.in_flight_tokens() + tokens <= self.token_quota
+
+    def in_flight_tokens(self):
+        with self.condition:
+            return sum(batch['tokens'] for batch in self.in_flight.values())
+
+    def in_flight_batches(self):
+        """Return {batch_id: {'tokens', 'file', 'sha256'}} for batches currently holding quota."""
+        with self.condition:
+            return {batch_id: dict(batch) for batch_id, batch in self.in_flight.items()}
+
+    def completed_hashes(self):
+        """Content hashes of batch files whose batches completed."""
+        with self.condition:
+            return set(self.finished_hashes)
+
+    def fits(self, tokens):
+        with self.condition:
+            return self._fits(tokens)
+
+    def wait_for_capacity(self, tokens, timeout=None):
+        """Block until a batch of `tokens` fits. Returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self._fits(tokens), timeout)
+
+    def acquire(self, batch_id, tokens, batch_file):
+        sha256 = file_sha256(batch_file)
+        with self.condition:
+            self.in_flight[batch_id] = {'tokens': tokens, 'file': batch_file, 'sha256': sha256}
+            self._save()
+
+    def release(self, batch_id, completed=False):
+        """Free the quota held by a finished batch. Only completed batches are remembered as done."""
+        with self.condition:
+            batch = self.in_flight.pop(batch_id, None)
+            if batch is None:
+                return
+            if completed:
+                self.finished_hashes.append(batch['sha256'])
+            self.releases += 1
+            self._save()
+            self.condition.notify_all()
 
 
 class AzureBatchManager:
-    def __init__(self, api_key, api_endpoint, api_version, deployment_name, batch_tracking_file):
+    def __init__(self, api_key, api_endpoint, api_version, deployment_name, batch_tracking_file, client=None):
         """
         Initialize Azure OpenAI Batch Manager.
         
@@ -179,8 +367,10 @@ class AzureBatchManager:
             api_version (str): API version
             deployment_name (str): Model deployment name
             batch_tracking_file (str): File to track submitted batch IDs
+            client: Pre-built client with the same files/batches API, e.g. MockBatchClient
+                (default: None, an AzureOpenAI client is created)
         """
-        self.client = AzureOpenAI(
+        self.client = client or AzureOpenAI(
             api_key=api_key,
             api_version=api_version,
             azure_endpoint=api_endpoint
@@ -198,16 +388,17 @@ class AzureBatchManager:
         """Submit a single batch job."""
         try:
             # Upload batch file
-            with open(batch_file_path, 'rb') as f:
+            with stage("upload"), open(batch_file_path, 'rb') as f:
                 batch_input_file = self.client.files.create(file=f, purpose='batch')
             
             # Create batch job
-            response = self.client.batches.create(
-                input_file_id=batch_input_file.id,
-                endpoint="/chat/completions",
-                completion_window="24h",
-                metadata={"description": f"Batch from {os.path.basename(batch_file_path)}"}
-            )
+            with stage("submit"):
+                response = self.client.batches.create(
+                    input_file_id=batch_input_file.id,
+                    endpoint="/chat/completions",
+                    completion_window="24h",
+                    metadata={"description": f"Batch from {os.path.basename(batch_file_path)}"}
+                )
             
             batch_id = response.id
             self.save_batch_id(batch_id, batch_file_path)
@@ -219,14 +410,109 @@ class AzureBatchManager:
             print(f"Error submitting batch {batch_file_path}: {e}")
             return None
 
-    def submit_all_batches(self, batch_dir):
-        """Submit all batch files in directory."""
+    def submit_all_batches(self, batch_dir, scheduler=None, poll_interval=60, max_attempts=3):
+        """
+        Submit all batch files in directory, within the scheduler's token quota if one is given.
+
+        Returns the batch files that could not be submitted (always empty without a scheduler).
+        """
         batch_files = [f for f in os.listdir(batch_dir) if f.endswith('.jsonl')]
         print(f"Found {len(batch_files)} batch files to submit")
         
+        if scheduler is not None:
+            batch_files.sort(key=lambda f: (len(f), f))  # batch_2 before batch_10
+            batch_paths = [os.path.join(batch_dir, f) for f in batch_files]
+            return self.submit_with_quota(batch_paths, scheduler, poll_interval, max_attempts)
+        
         for batch_file in batch_files:
             batch_path = os.path.join(batch_dir, batch_file)
             self.submit_batch(batch_path)
+        return []
+
+    def submit_with_quota(self, batch_paths, scheduler, poll_interval=60, max_attempts=3):
+        """
+        Submit batch files in order without exceeding the scheduler's token quota.
+
+        Whenever the next batch does not fit, waits for in-flight batches to finish.
+        Batches rejected with token_limit_exceeded and failed uploads are tried
+        again, after another batch has released its quota or after a backoff of
+        poll_interval doubling per attempt, and given up after max_attempts.
+        Files whose content already completed are skipped and batches still in
+        flight from an earlier run are polled instead of submitted again, so an
+        interrupted run can be resumed.
+        Returns the files given up on, once every other batch has been submitted
+        and none is in flight.
+        """
+        self.release_finished(scheduler)  # rejected or failed in an earlier run: submit again below
+        in_flight = {batch['sha256'] for batch in scheduler.in_flight_batches().values()}
+        done = scheduler.completed_hashes()
+        pending = [p for p in batch_paths if file_sha256(p) not in done | in_flight]
+        if len(pending) < len(batch_paths):
+            print(f"Skipping {len(batch_paths) - len(pending)} batches completed or in flight from an earlier run")
+        tokens, attempts, held, gave_up = {}, {}, {}, []
+        
+        def retry_later(path, reason):
+            attempts[path] = attempts.get(path, 0) + 1
+            if attempts[path] >= max_attempts:
+                print(f"Error: giving up on {path} after {attempts[path]} attempts ({reason})")
+                gave_up.append(path)
+                return False
+            # eligible again once another batch releases quota, or after the backoff
+            held[path] = (scheduler.releases, time.monotonic() + poll_interval * 2 ** (attempts[path] - 1))
+            return True
+        
+        while True:
+            for path in self.release_finished(scheduler):
+                if path not in pending and retry_later(path, 'token_limit_exceeded'):
+                    pending.insert(0, path)
+            
+            for path in list(pending):
+                if path in held:
+                    releases, deadline = held[path]
+                    if scheduler.releases == releases and time.monotonic() < deadline:
+                        continue
+                    del held[path]
+                if path not in tokens:
+                    tokens[path] = estimate_batch_tokens(path)
+                if not scheduler.fits(tokens[path]):
+                    break
+                batch_id = self.submit_batch(path)
+                if batch_id:
+                    scheduler.acquire(batch_id, tokens[path], path)
+                    pending.remove(path)
+                elif not retry_later(path, 'upload failed'):
+                    pending.remove(path)
+            
+            in_flight = scheduler.in_flight_batches()
+            if not pending and not in_flight:
+                return gave_up
+            print(f"{len(pending)} batches waiting, {len(in_flight)} in flight: "
+                  f"{scheduler.in_flight_tokens()}/{scheduler.token_quota} estimated tokens in flight")
+            time.sleep(poll_interval)
+
+    def release_finished(self, scheduler):
+        """
+        Release the quota of in-flight batches that have finished.
+
+        Returns the files of batches that failed with token_limit_exceeded, which
+        should be submitted again. Batches that failed otherwise are not recorded
+        as completed, so a later run submits them again.
+        """
+        requeue = []
+        for batch_id, batch in scheduler.in_flight_batches().items():
+            status = self.check_status(batch_id)
+            if status not in FINISHED_STATUSES:
+                continue
+            scheduler.release(batch_id, completed=status == 'completed')
+            if status == 'completed':
+                continue
+            if status == 'failed' and 'token_limit_exceeded' in self.batch_error_codes(batch_id):
+                print(f"Batch {batch_id} exceeded the enqueued-token quota, queuing {batch['file']} again")
+                requeue.append(batch['file'])
+            else:
+                print(f"Batch {batch_id} from {batch['file']} ended with status {status}; "
+                      f"it will be submitted again by the next run")
+        return requeue
 
     def check_status(self, batch_id):
         """Check status of a batch job."""
@@ -235,7 +521,18 @@ class AzureBatchManager:
             return response.status
         except Exception as e:
             print(f"Error checking status for {batch_id}: {e}")
-            return "error"
+            # e.g. openai.NotFoundError: the service does not know this batch id
+            return "not_found" if getattr(e, 'status_code', None) == 404 else "error"
+
+    def batch_error_codes(self, batch_id):
+        """Return the error codes reported for a failed batch job (e.g. token_limit_exceeded)."""
+        try:
+            response = self.client.batches.retrieve(batch_id)
+            errors = getattr(response, 'errors', None)
+            return [error.code for error in (getattr(errors, 'data', None) or [])]
+        except Exception as e:
+            print(f"Error reading errors for {batch_id}: {e}")
+            return []
 
     def retrieve_results(self, batch_id, output_dir):
         """Retrieve results for a completed batch."""
@@ -244,7 +541,8 @@ class AzureBatchManager:
             
             if response.status == "completed":
                 output_file = os.path.join(output_dir, f"batch_output_{batch_id}.jsonl")
-                file_response = self.client.files.content(response.output_file_id)
+                with stage("download"):
+                    file_response = self.client.files.content(response.output_file_id)
                 
                 with open(output_file, 'w') as f:
                     f.write(file_response.text)
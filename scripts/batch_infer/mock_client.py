@@ -0,0 +1,139 @@
+"""
+Local stand-in for the Azure OpenAI files/batches API.
+
+Used by run_pipeline.py --mock to exercise the whole pipeline (build, upload,
+poll, download, merge) without credentials or network access. Every request
+gets a canned JSON explanation, and a batch completes after a few status polls.
+With a token quota, a batch that does not fit next to the unfinished ones fails
+with token_limit_exceeded, like an Azure deployment over its enqueued-token quota.
+With a state_dir, files and batches are kept on disk, so a resumed pipeline run
+finds the batches it submitted before it was interrupted.
+"""
+import json
+import os
+import threading
+import uuid
+from types import SimpleNamespace
+
+from batch_processor import estimate_request_tokens
+
+
+class MockNotFoundError(KeyError):
+    """Unknown file or batch id; status_code matches openai.NotFoundError."""
+    status_code = 404
+
+
+class MockBatchClient:
+    def __init__(self, polls_until_complete=2, token_quota=None, state_dir=None):
+        """
+        Args:
+            polls_until_complete (int): Number of batches.retrieve calls before a batch completes
+            token_quota (int): Enqueued-token quota to enforce (default: None, unlimited)
+            state_dir (str): Directory persisting files and batches across runs (default: None, in memory)
+        """
+        self.polls_until_complete = polls_until_complete
+        self.token_quota = token_quota
+        self.state_dir = state_dir
+        self._files = {}
+        self._batches = {}
+        self._lock = threading.RLock()
+        if state_dir:
+            os.makedirs(os.path.join(state_dir, 'files'), exist_ok=True)
+            batches_path = os.path.join(state_dir, 'batches.json')
+            if os.path.exists(batches_path):
+                with open(batches_path, 'r') as f:
+                    self._batches = json.load(f)
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    @staticmethod
+    def _new_id(prefix):
+        # unique across runs, so resumed pipelines never reuse a result file name
+        return f"{prefix}-{uuid.uuid4().hex[:12]}"
+
+    def _save_batches(self):
+        if not self.state_dir:
+            return
+        with self._lock:
+            path = os.path.join(self.state_dir, 'batches.json')
+            with open(f"{path}.tmp", 'w') as f:
+                json.dump(self._batches, f)
+            os.replace(f"{path}.tmp", path)
+
+    def _store_file(self, file_id, text):
+        self._files[file_id] = text
+        if self.state_dir:
+            with open(os.path.join(self.state_dir, 'files', file_id), 'w') as f:
+                f.write(text)
+
+    def _load_file(self, file_id):
+        if file_id not in self._files and self.state_dir:
+            path = os.path.join(self.state_dir, 'files', file_id)
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    self._files[file_id] = f.read()
+        if file_id not in self._files:
+            raise MockNotFoundError(f"No such file: {file_id}")
+        return self._files[file_id]
+
+    def _create_file(self, file, purpose):
+        file_id = self._new_id("file")
+        self._store_file(file_id, file.read().decode('utf-8'))
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def _file_content(self, file_id):
+        return SimpleNamespace(text=self._load_file(file_id))
+
+    def _create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+        batch_id = self._new_id("batch")
+        tokens = sum(estimate_request_tokens(json.loads(line)) for line in self._load_file(input_file_id).splitlines())
+        with self._lock:
+            enqueued = sum(b["tokens"] for b in self._batches.values()
+                           if b["output_file_id"] is None and not b["rejected"])
+            rejected = self.token_quota is not None and enqueued + tokens > self.token_quota
+            self._batches[batch_id] = {"input_file_id": input_file_id, "polls": 0, "output_file_id": None,
+                                       "tokens": tokens, "rejected": rejected}
+            self._save_batches()
+        return SimpleNamespace(id=batch_id, status="validating")
+
+    def _retrieve_batch(self, batch_id):
+        if batch_id not in self._batches:
+            raise MockNotFoundError(f"No such batch: {batch_id}")
+        batch = self._batches[batch_id]
+        if batch["rejected"]:
+            errors = SimpleNamespace(data=[SimpleNamespace(code="token_limit_exceeded",
+                                                           message="Enqueued token limit reached")])
+            return SimpleNamespace(id=batch_id, status="failed", output_file_id=None, errors=errors)
+        with self._lock:
+            batch["polls"] += 1
+            if batch["polls"] >= self.polls_until_complete and batch["output_file_id"] is None:
+                output_file_id = self._new_id("file")
+                self._store_file(output_file_id, self._respond(self._load_file(batch["input_file_id"])))
+                batch["output_file_id"] = output_file_id
+            self._save_batches()
+        status = "completed" if batch["output_file_id"] else "in_progress"
+        return SimpleNamespace(id=batch_id, status=status, output_file_id=batch["output_file_id"], errors=None)
+
+    @staticmethod
+    def _respond(input_jsonl):
+        """Build a batch output file answering every request line."""
+        lines = []
+        for line in input_jsonl.splitlines():
+            request = json.loads(line)
+            custom_id = request['custom_id']
+            content = json.dumps({"explanation": f"Mock explanation for {custom_id}"})
+            lines.append(json.dumps({
+                "custom_id": custom_id,
+                "response": {
+                    "status_code": 200,
+                    "body": {
+                        "choices": [{"message": {"role": "assistant", "content": content}}],
+                        "usage": {
+                            "prompt_tokens": 1000,
+                            "completion_tokens": 100,
+                            "prompt_tokens_details": {"cached_tokens": 0},
+                        },
+                    },
+                },
+            }))
+        return '\n'.join(lines) + '\n'
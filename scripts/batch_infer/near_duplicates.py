@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Find near-duplicate images (reposted memes) in a dataset with perceptual hashes.
+
+Each image gets a 64-bit pHash or dHash, so re-compressed, slightly cropped or
+watermarked copies differ in only a few bits. Pairs within --threshold bits are
+found with a multi-index hash table, so each lookup only inspects a few buckets
+instead of the whole dataset, and are merged into clusters.
+
+Items within the threshold of a representative image that also have the same
+OCR text and class label would get the same explanation. With --near_duplicates, 1_submit_batches.py and run_pipeline.py
+send only one representative of each such group, and
+3_merge_results_explanation.py copies its explanation to the other members.
+
+Hashing requires Pillow and numpy (pip install pillow numpy); the scripts that
+only read the report do not.
+
+Usage:
+    python near_duplicates.py \
+        --dataset /path/to/dataset.jsonl \
+        --output ./near_duplicates.json \
+        --method phash \
+        --threshold 8
+"""
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+from collections import defaultdict
+from functools import lru_cache
+from itertools import combinations
+from math import comb
+
+from batch_processor import item_id
+
+HASH_BITS = 64
+HASH_METHODS = ('phash', 'dhash')
+
+
+def setup_logging():
+    """Configure logging."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+
+def normalize_text(text):
+    return ' '.join((text or '').split())
+
+
+########## perceptual hashes
+
+def _bits_to_int(bits):
+    import numpy as np
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), 'big')
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(n):
+    """DCT-II basis; the scale factor does not matter for a median threshold."""
+    import numpy as np
+    k = np.arange(n)[:, None]
+    return np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+
+
+def phash(image):
+    """DCT hash: signs of the 8x8 lowest frequencies of a 32x32 grayscale copy against their median."""
+    import numpy as np
+    from PIL import Image
+    pixels = np.asarray(image.convert('L').resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    dct = _dct_matrix(32)
+    low = (dct @ pixels @ dct.T)[:8, :8]
+    return _bits_to_int(low > np.median(low))
+
+
+def dhash(image):
+    """Gradient hash: whether each pixel of a 9x8 grayscale copy is brighter than its left neighbour."""
+    import numpy as np
+    from PIL import Image
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def hash_image(args):
+    """Return (path, hash or None) for one image; used as a pool task."""
+    path, method = args
+    from PIL import Image
+    try:
+        with Image.open(path) as image:
+            image.draft('RGB', (128, 128))  # JPEG: decode at reduced size, much faster for large photos
+            return path, (phash if method == 'phash' else dhash)(image)
+    except Exception as e:
+        logging.warning(f"Could not hash {path}: {e}")
+        return path, None
+
+
+def load_hash_cache(cache_file, method):
+    """Hashes from earlier runs, keyed by path and valid while size and mtime are unchanged."""
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # truncated line from an interrupted run
+                if entry['method'] == method:
+                    cache[entry['path']] = entry
+    return cache
+
+
+def hash_images(paths, method='phash', num_workers=1, cache_file=None):
+    """Return {path: hash} for all readable images, hashing in a process pool and reusing cached hashes."""
+    cache = load_hash_cache(cache_file, method)
+    hashes, todo = {}, []
+    for path in dict.fromkeys(paths):
+        if not os.path.exists(path):
+            logging.warning(f"Image not found: {path}")
+            continue
+        stat = os.stat(path)
+        entry = cache.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            hashes[path] = int(entry['hash'], 16)
+        else:
+            todo.append(path)
+
+    logging.info(f"Hashing {len(todo)} images ({len(hashes)} cached) with {method}")
+    tasks = [(path, method) for path in todo]
+    if num_workers > 1 and len(tasks) > 1:
+        with mp.Pool(num_workers) as pool:
+            computed = pool.map(hash_image, tasks, chunksize=max(1, len(tasks) // (num_workers * 16)))
+    else:
+        computed = [hash_image(task) for task in tasks]
+
+    new_entries = []
+    for path, value in computed:
+        if value is None:
+            continue
+        hashes[path] = value
+        stat = os.stat(path)
+        new_entries.append({'path': path, 'method': method, 'hash': f"{value:016x}",
+                            'size': stat.st_size, 'mtime': stat.st_mtime})
+    if cache_file and new_entries:
+        with open(cache_file, 'a') as f:
+            for entry in new_entries:
+                f.write(json.dumps(entry) + '\n')
+    return hashes
+
+
+########## index and clustering
+
+class MultiIndexHashIndex:
+    """
+    Hamming-distance index over 64-bit hashes (multi-index hashing).
+
+    Hashes are split into m chunks, each with its own hash table. Two hashes
+    within `threshold` bits must differ in at most threshold // m bits in at
+    least one chunk, so a query only probes the buckets of chunk values within
+    that radius and verifies the full distance of the candidates found there.
+    m is chosen to balance the number of probes against the expected number of
+    candidates for an index of `expected_size` hashes.
+    """
+
+    def __init__(self, threshold, expected_size=100000, bits=HASH_BITS):
+        self.threshold = threshold
+        num_chunks = min(range(1, min(bits, threshold + 1) + 1),
+                         key=lambda m: self._query_cost(m, threshold, bits, expected_size))
+        self.radius = threshold // num_chunks
+        self.chunks = []  # (shift, mask, XOR masks flipping up to `radius` bits)
+        shift = 0
+        for size in self._chunk_sizes(num_chunks, bits):
+            flips = [sum(1 << b for b in flipped) for r in range(self.radius + 1)
+                     for flipped in combinations(range(size), r)]
+            self.chunks.append((shift, (1 << size) - 1, flips))
+            shift += size
+        self.tables = [defaultdict(list) for _ in self.chunks]
+        self.hashes = []
+
+    @staticmethod
+    def _chunk_sizes(num_chunks, bits):
+        return [bits // num_chunks + (1 if i < bits % num_chunks else 0) for i in range(num_chunks)]
+
+    @classmethod
+    def _query_cost(cls, num_chunks, threshold, bits, expected_size):
+        """Bucket probes plus expected candidates per query, for uniformly distributed hashes."""
+        radius = threshold // num_chunks
+        cost = 0.0
+        for size in cls._chunk_sizes(num_chunks, bits):
+            probes = sum(comb(size, r) for r in range(radius + 1))
+            cost += probes + expected_size * probes / 2 ** size
+        return cost
+
+    def add(self, value):
+        """Store a hash and return its position."""
+        position = len(self.hashes)
+        self.hashes.append(value)
+        for table, (shift, mask, _) in zip(self.tables, self.chunks):
+            table[(value >> shift) & mask].append(position)
+        return position
+
+    def query(self, value):
+        """Return positions of stored hashes within `threshold` bits of value."""
+        candidates = set()
+        for table, (shift, mask, flips) in zip(self.tables, self.chunks):
+            chunk = (value >> shift) & mask
+            for flip in flips:
+                bucket = table.get(chunk ^ flip)
+                if bucket:
+                    candidates.update(bucket)
+        hashes = self.hashes
+        return [p for p in candidates if (hashes[p] ^ value).bit_count() <= self.threshold]
+
+
+def find_clusters(hashes, threshold):
+    """
+    Group keys whose hashes are within `threshold` bits, transitively.
+
+    Args:
+        hashes (dict): key -> 64-bit hash
+
+    Returns:
+        list of clusters (lists of keys, in input order) with at least two members
+    """
+    keys = list(hashes)
+    parent = list(range(len(keys)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    index = MultiIndexHashIndex(threshold, expected_size=len(keys))
+    for i, key in enumerate(keys):
+        for j in index.query(hashes[key]):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+        index.add(hashes[key])
+
+    groups = defaultdict(list)
+    for i, key in enumerate(keys):
+        groups[find(i)].append(key)
+    return [members for members in groups.values() if len(members) > 1]
+
+
+def reuse_groups(items, hashes, threshold):
+    """
+    Pick items that can reuse the explanation of a representative.
+
+    Clusters from find_clusters are transitive, so their ends can be unrelated
+    images. Here every duplicate is within `threshold` bits of its own
+    representative and has the same normalized OCR text and class_label (the
+    prompt is conditioned on the label). Representatives are taken in dataset order.
+
+    Args:
+        items (list): Dataset items, in dataset order
+        hashes (dict): item id -> 64-bit hash
+        threshold (int): Maximum Hamming distance to the representative
+
+    Returns:
+        dict: representative id -> ids of its duplicates
+    """
+    group_key = {item_id(item): (normalize_text(item.get('text', item.get('extracted_text', ''))),
+                                 item.get('class_label'))
+                 for item in items}
+    keys = [key for key in dict.fromkeys(item_id(item) for item in items) if key in hashes]
+    index = MultiIndexHashIndex(threshold, expected_size=len(keys))
+    for key in keys:
+        index.add(hashes[key])
+
+    assigned, reuse = set(), {}
+    for key in keys:
+        if key in assigned:
+            continue
+        assigned.add(key)
+        duplicates = [keys[p] for p in sorted(index.query(hashes[key]))
+                      if keys[p] not in assigned and group_key[keys[p]] == group_key[key]]
+        if duplicates:
+            assigned.update(duplicates)
+            reuse[key] = duplicates
+    return reuse
+
+
+def load_reuse_map(near_duplicates_file):
+    """Read the representative -> duplicates mapping written by this script."""
+    with open(near_duplicates_file, 'r', encoding='utf-8') as f:
+        return json.load(f)['reuse']
+
+
+def copy_to_duplicates(results, reuse):
+    """Give every duplicate the result of its representative. Returns the number of items filled in."""
+    copied = 0
+    for representative, duplicates in reuse.items():
+        if representative in results:
+            for duplicate in duplicates:
+                results[duplicate] = results[representative]
+                copied += 1
+    return copied
+
+
+def resolve_path(img_path, image_root):
+    return img_path if os.path.isabs(img_path) or not image_root else os.path.join(image_root, img_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find near-duplicate images with perceptual hashes')
+    parser.add_argument('--dataset', required=True, help='Path to JSONL dataset file')
+    parser.add_argument('--output', default='./near_duplicates.json', help='Output JSON report')
+    parser.add_argument('--method', choices=HASH_METHODS, default='phash', help='Perceptual hash')
+    parser.add_argument('--threshold', type=int, default=8,
+                        help='Maximum Hamming distance (of 64 bits) between near-duplicate images')
+    parser.add_argument('--image_root', default='',
+                        help='Directory that relative img_path values are resolved against')
+    parser.add_argument('--hash_cache', default='./image_hashes.jsonl',
+                        help="Cache of computed hashes, reused while files are unchanged ('' disables)")
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count() or 1, help='Hashing processes')
+
+    args = parser.parse_args()
+    setup_logging()
+
+    try:
+        import numpy  # noqa: F401
+        import PIL  # noqa: F401
+    except ImportError:
+        logging.error("Pillow and numpy are required: pip install pillow numpy")
+        return
+
+    with open(args.dataset, 'r', encoding='utf-8') as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    items = [item for item in items if 'img_path' in item]
+
+    paths = {item_id(item): resolve_path(item['img_path'], args.image_root) for item in items}
+    path_hashes = hash_images(paths.values(), args.method, args.num_workers, args.hash_cache or None)
+    hashes = {key: path_hashes[path] for key, path in paths.items() if path in path_hashes}
+
+    clusters = find_clusters(hashes, args.threshold)
+    reuse = reuse_groups(items, hashes, args.threshold)
+    skipped = sum(len(duplicates) for duplicates in reuse.values())
+
+    report = {
+        'method': args.method,
+        'threshold': args.threshold,
+        'num_images': len(hashes),
+        'num_clusters': len(clusters),
+        'num_clustered_images': sum(len(c) for c in clusters),
+        'num_reusable': skipped,
+        'clusters': sorted(clusters, key=len, reverse=True),
+        'reuse': reuse,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    logging.info(f"✓ {len(clusters)} near-duplicate clusters covering {report['num_clustered_images']} "
+                 f"of {len(hashes)} images")
+    logging.info(f"  {skipped} items share image, text and label with a representative and can reuse its explanation")
+    logging.info(f"  Report: {args.output}")
+    logging.info(f"Pass --near_duplicates {args.output} to 1_submit_batches.py and 3_merge_results_explanation.py")
+
+
+if __name__ == "__main__":
+    main()
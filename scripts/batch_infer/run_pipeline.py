@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Run build, submit, retrieve and merge as one pipelined command.
+
+The stages overlap: batch N is uploaded and submitted while batch N+1 is still
+being encoded, and finished batches are downloaded and merged into the output
+while other batches are still running. Progress is kept in a state file in
+--work_dir, so after a crash the same command continues where it stopped.
+
+Usage:
+    python run_pipeline.py \
+        --dataset /path/to/dataset.jsonl \
+        --prompt /path/to/prompt.txt \
+        --env_file .env \
+        --work_dir ./run \
+        --output ./dataset_with_explanations.jsonl
+
+    # Against the local mock API (no credentials needed)
+    python run_pipeline.py --mock \
+        --dataset /path/to/dataset.jsonl \
+        --prompt prompts/armeme_explanation_english.txt \
+        --work_dir ./mock_run \
+        --output ./mock_output.jsonl
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))  # profiling.py
+from batch_processor import (MultimodalBatchProcessor, AzureBatchManager, TokenQuotaScheduler, estimate_batch_tokens,
+                             quota_batch_token_limit)
+from near_duplicates import copy_to_duplicates, load_reuse_map
+from profiling import add_profile_args, run_profiled, stage
+
+# Step 3 lives in a module whose name starts with a digit
+merge_step = importlib.import_module('3_merge_results_explanation')
+
+FAILED_STATUSES = ('failed', 'expired', 'cancelled', 'not_found')
+
+
+def setup_logging():
+    """Configure logging."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'
+    )
+
+
+def load_env_variables(env_file):
+    """Load Azure OpenAI credentials from env file."""
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=env_file, override=True)
+
+    return {
+        'api_key': os.environ['AZURE_API_KEY'],
+        'api_endpoint': os.environ['AZURE_API_URL'],
+        'api_version': os.environ['AZURE_API_VERSION'],
+        'deployment_name': os.environ['AZURE_ENGINE_NAME']
+    }
+
+
+class PipelineState:
+    """
+    Progress of a pipeline run, persisted as JSON after every change.
+
+    Batch status goes built -> submitted -> completed (downloaded) -> merged,
+    or ends in failed; failed batches go back to built when the run is resumed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'build_done': False, 'next_item': 0, 'next_counter': 1, 'batches': {}}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.data = json.load(f)
+
+    def save(self):
+        with self.lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def add_batch(self, name, batch_file, next_item, next_counter, num_items):
+        with self.lock:
+            self.data['batches'][name] = {'file': batch_file, 'items': num_items, 'status': 'built'}
+            self.data['next_item'] = next_item
+            self.data['next_counter'] = next_counter
+        self.save()
+
+    def update_batch(self, name, **fields):
+        with self.lock:
+            self.data['batches'][name].update(fields)
+        self.save()
+
+    def set(self, **fields):
+        with self.lock:
+            self.data.update(fields)
+        self.save()
+
+    def retry_failed(self):
+        """Reset failed batches to built, with fresh retry counters. Returns their names."""
+        with self.lock:
+            names = [name for name, b in self.data['batches'].items() if b['status'] == 'failed']
+            for name in names:
+                batch = self.data['batches'][name]
+                self.data['batches'][name] = {'file': batch['file'], 'items': batch['items'], 'status': 'built'}
+        self.save()
+        return names
+
+    def batches(self, *statuses):
+        with self.lock:
+            return [(name, dict(b)) for name, b in self.data['batches'].items() if b['status'] in statuses]
+
+
+def build_stage(processor, deployment_name, state, submit_queue):
+    """Encode batch files one by one and hand each to the submitter as soon as it is saved."""
+    try:
+        for counter, batch_file, next_item, num_items in processor.iter_batches(
+                deployment_name,
+                start_item=state.data['next_item'],
+                start_counter=state.data['next_counter']):
+            name = f"batch_{counter}"
+            state.add_batch(name, batch_file, next_item, counter + 1, num_items)
+            submit_queue.put(name)
+        state.set(build_done=True)
+        logging.info("All batch files built")
+    finally:
+        submit_queue.put(None)
+
+
+def submit_stage(manager, state, submit_queue, max_retries, retry_delay, scheduler=None):
+    """Upload and submit batches as they arrive from the builder, holding each until it fits in the quota."""
+    while True:
+        name = submit_queue.get()
+        if name is None:
+            return
+        batch_file = state.data['batches'][name]['file']
+        if scheduler is not None:
+            tokens = estimate_batch_tokens(batch_file)
+            if not scheduler.fits(tokens):
+                logging.info(f"Holding {name} (~{tokens} tokens) until enqueued-token quota frees up")
+                scheduler.wait_for_capacity(tokens)
+        for attempt in range(1, max_retries + 1):
+            batch_id = manager.submit_batch(batch_file)
+            if batch_id:
+                if scheduler is not None:
+                    scheduler.acquire(batch_id, tokens, batch_file)
+                state.update_batch(name, status='submitted', batch_id=batch_id)
+                break
+            logging.warning(f"Submitting {name} failed (attempt {attempt}/{max_retries})")
+            time.sleep(retry_delay)
+        else:
+            state.update_batch(name, status='failed', error='submission failed')
+
+
+def poll_stage(manager, state, results_dir, scheduler=None, max_status_errors=5, max_rejections=3, retry_delay=60):
+    """Check submitted batches once and download the ones that finished. Returns names of new downloads.
+
+    Batches rejected for exceeding the enqueued-token quota go back to 'built' to be submitted again
+    once ready_to_resubmit, and are marked failed after max_rejections rejections.
+    A batch whose status cannot be read max_status_errors times in a row is marked failed.
+    """
+    downloaded = []
+    for name, batch in state.batches('submitted'):
+        status = manager.check_status(batch['batch_id'])
+        if status == 'error':
+            errors = batch.get('status_errors', 0) + 1
+            if errors < max_status_errors:
+                state.update_batch(name, status_errors=errors)
+                continue
+            logging.error(f"Giving up on {name} ({batch['batch_id']}) after {errors} failed status checks")
+            state.update_batch(name, status='failed', error='status unavailable', status_errors=errors)
+            if scheduler is not None:
+                scheduler.release(batch['batch_id'])
+            continue
+        elif batch.get('status_errors'):
+            state.update_batch(name, status_errors=0)
+        if status == 'completed':
+            output_file = manager.retrieve_results(batch['batch_id'], results_dir)
+            if output_file:
+                state.update_batch(name, status='completed', output_file=output_file)
+                downloaded.append(name)
+                if scheduler is not None:
+                    scheduler.release(batch['batch_id'], completed=True)
+        elif status in FAILED_STATUSES:
+            rejected = status == 'failed' and 'token_limit_exceeded' in manager.batch_error_codes(batch['batch_id'])
+            if scheduler is not None:
+                scheduler.release(batch['batch_id'])
+            rejections = batch.get('rejections', 0) + rejected
+            if rejected and rejections < max_rejections:
+                logging.warning(f"Batch {name} exceeded the enqueued-token quota "
+                                f"({rejections}/{max_rejections}), resubmitting")
+                state.update_batch(name, status='built', batch_id=None, rejections=rejections,
+                                   retry_at=time.time() + retry_delay * 2 ** (rejections - 1),
+                                   retry_after_releases=scheduler.releases if scheduler is not None else None)
+            else:
+                error = 'token_limit_exceeded' if rejected else status
+                logging.error(f"Batch {name} ({batch['batch_id']}) ended with {error}")
+                state.update_batch(name, status='failed', error=error, rejections=rejections)
+    return downloaded
+
+
+def ready_to_resubmit(batch, scheduler=None):
+    """A rejected batch is resubmitted after its backoff, or earlier once another batch has released quota."""
+    if time.time() >= batch.get('retry_at', 0):
+        return True
+    return scheduler is not None and scheduler.releases != batch.get('retry_after_releases')
+
+
+def write_output(dataset_path, results, output_path, warn_missing=False, reuse=None):
+    """Rewrite the merged dataset atomically so a crash never leaves a half-written file."""
+    if reuse:
+        copy_to_duplicates(results, reuse)
+    tmp_path = f"{output_path}.tmp"
+    merged_count, total_count = merge_step.merge_with_dataset(
+        dataset_path, results, tmp_path, warn_missing=warn_missing
+    )
+    os.replace(tmp_path, output_path)
+    return merged_count, total_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build, submit, retrieve and merge batches in one pipelined run')
+    parser.add_argument('--dataset', required=True, help='Path to JSONL dataset file')
+    parser.add_argument('--prompt', required=True, help='Path to instruction prompt text file')
+    parser.add_argument('--env_file', help='Path to .env file with Azure credentials (not needed with --mock)')
+    parser.add_argument('--work_dir', default='./pipeline_run',
+                        help='Directory for batch files, results and the resumable state file')
+    parser.add_argument('--output', default='./dataset_with_explanations.jsonl', help='Output JSONL file')
+    parser.add_argument('--instruction_in_system', action='store_true',
+                        help='Put the static instruction in a leading system message (enables prompt-prefix caching)')
+    parser.add_argument('--poll_interval', type=float, default=60, help='Seconds between status checks')
+    parser.add_argument('--max_submit_retries', type=int, default=3,
+                        help='Submission attempts per batch, and quota rejections after which a batch is marked failed')
+    parser.add_argument('--max_status_errors', type=int, default=5,
+                        help='Consecutive failed status checks after which a batch is marked failed')
+    parser.add_argument('--token_quota', type=int,
+                        help='Enqueued-token quota of the deployment; batches are held back until they fit')
+    parser.add_argument('--mock', action='store_true', help='Use the local mock API instead of Azure OpenAI')
+    parser.add_argument('--mock_token_quota', type=int, help='Enqueued-token quota enforced by the mock API')
+    parser.add_argument('--near_duplicates',
+                        help='Report from near_duplicates.py; duplicates are not sent and reuse their representative\'s explanation')
+    add_profile_args(parser)
+
+    args = parser.parse_args()
+    setup_logging()
+
+    # Validate inputs
+    for path, what in ((args.dataset, 'Dataset'), (args.prompt, 'Prompt file')):
+        if not os.path.exists(path):
+            logging.error(f"{what} not found: {path}")
+            return
+    if not args.mock and not (args.env_file and os.path.exists(args.env_file)):
+        logging.error(f"Environment file not found: {args.env_file}")
+        return
+
+    reuse = load_reuse_map(args.near_duplicates) if args.near_duplicates else {}
+
+    batches_dir = os.path.join(args.work_dir, 'batches')
+    results_dir = os.path.join(args.work_dir, 'results')
+    os.makedirs(batches_dir, exist_ok=True)
+    os.makedirs(results_dir, exist_ok=True)
+
+    if args.mock:
+        from mock_client import MockBatchClient
+        env_vars = {'api_key': None, 'api_endpoint': None, 'api_version': None, 'deployment_name': 'mock-deployment'}
+        client = MockBatchClient(token_quota=args.mock_token_quota,
+                                 state_dir=os.path.join(args.work_dir, 'mock_api'))
+    else:
+        logging.info("Loading Azure OpenAI credentials...")
+        env_vars = load_env_variables(args.env_file)
+        client = None
+
+    processor = MultimodalBatchProcessor(
+        dataset_path=args.dataset,
+        prompt_file=args.prompt,
+        output_dir=batches_dir,
+        instruction_in_system=args.instruction_in_system,
+        batch_token_limit=quota_batch_token_limit(args.token_quota),
+        skip_ids={d for duplicates in reuse.values() for d in duplicates}
+    )
+    manager = AzureBatchManager(
+        api_key=env_vars['api_key'],
+        api_endpoint=env_vars['api_endpoint'],
+        api_version=env_vars['api_version'],
+        deployment_name=env_vars['deployment_name'],
+        batch_tracking_file=os.path.join(args.work_dir, 'batch_tracking.txt'),
+        client=client
+    )
+    state = PipelineState(os.path.join(args.work_dir, 'pipeline_state.json'))
+    scheduler = None
+    if args.token_quota:
+        scheduler = TokenQuotaScheduler(args.token_quota, os.path.join(args.work_dir, 'quota_state.json'))
+
+    # Resume: reload everything already downloaded, re-queue batches that were built but not submitted or failed
+    results, usage_totals = {}, merge_step.new_usage_totals()
+    for _, batch in state.batches('completed', 'merged'):
+        merge_step.load_result_file(batch['output_file'], results, usage_totals)
+    for name, _ in state.batches('completed'):
+        state.update_batch(name, status='merged')
+
+    retried = state.retry_failed()
+    if retried:
+        logging.info(f"Retrying {len(retried)} batches that failed in an earlier run: {', '.join(retried)}")
+
+    submit_queue = queue.Queue()
+    for name, _ in state.batches('built'):
+        submit_queue.put(name)
+
+    builder = None
+    if state.data['build_done']:
+        submit_queue.put(None)
+    else:
+        builder = threading.Thread(target=build_stage, name='build', daemon=True,
+                                   args=(processor, env_vars['deployment_name'], state, submit_queue))
+        builder.start()
+    def start_submitter(submit_queue):
+        submitter = threading.Thread(target=submit_stage, name='submit', daemon=True,
+                                     args=(manager, state, submit_queue, args.max_submit_retries,
+                                           args.poll_interval, scheduler))
+        submitter.start()
+        return submitter
+
+    submitter = start_submitter(submit_queue)
+
+    # Poll and merge in the main thread until every batch has finished
+    while True:
+        downloaded = poll_stage(manager, state, results_dir, scheduler, args.max_status_errors,
+                                args.max_submit_retries, args.poll_interval)
+        for name in downloaded:
+            with stage("parse"):
+                merge_step.load_result_file(state.data['batches'][name]['output_file'], results, usage_totals)
+            state.update_batch(name, status='merged')
+        if downloaded:
+            merged_count, total_count = write_output(args.dataset, results, args.output, reuse=reuse)
+            logging.info(f"Merged {', '.join(downloaded)}: {merged_count}/{total_count} items have explanations")
+
+        building = builder is not None and builder.is_alive()
+        if not building and not submitter.is_alive():
+            resubmit = [(name, batch) for name, batch in state.batches('built') if ready_to_resubmit(batch, scheduler)]
+            if resubmit:
+                # batches rejected by the quota after the submitter had finished
+                submit_queue = queue.Queue()
+                for name, _ in resubmit:
+                    submit_queue.put(name)
+                submit_queue.put(None)
+                submitter = start_submitter(submit_queue)
+            elif not state.batches('submitted', 'built'):
+                break
+        time.sleep(args.poll_interval)
+
+    if state.data['build_done'] and not state.data['batches']:
+        logging.error("No batch files were built: every item was skipped or failed to encode (see the errors above)")
+        return 1
+
+    merged_count, total_count = write_output(args.dataset, results, args.output, warn_missing=True, reuse=reuse)
+    merge_step.log_token_usage(usage_totals)
+    failed = state.batches('failed')
+    if not state.data['build_done']:
+        logging.error("Building batch files stopped early; re-run the same command to resume")
+        return 1
+
+    logging.info("Pipeline finished with failed batches" if failed else "✓ Pipeline complete!")
+    logging.info(f"  Output file: {args.output}")
+    logging.info(f"  Success rate: {merged_count}/{total_count} ({100*merged_count/max(total_count, 1):.1f}%)")
+    if failed:
+        logging.error(f"  {len(failed)} batches failed: {', '.join(name for name, _ in failed)}; "
+                      f"re-run the same command to retry them")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(run_profiled(main))
@@ -10,28 +10,21 @@
 #     --is_arabic
 
 
+# python scripts/src/compute_metrics.py \
+#   --data "result/**/*.jsonl" \
+#   --out_dir scores \
+#   --flags_from_name
+
+
 DATA_DIR="./result/zero-shot/Hateful_Meme"
 OUT_DIR="./scores/zero-shot/Hateful_Meme"
 SCRIPT="./scripts/src/compute_metrics.py"
 
-for file in "$DATA_DIR"/*.jsonl; do
-    echo "Processing $file ..."
-    base=$(basename "$file" .jsonl)
-
-    # Check conditions for extra args
-    ARGS=""
-    if [[ "$file" == *"explanation"* ]]; then
-        ARGS="$ARGS --has_explanation"
-    fi
-    if [[ "$file" == *"_ar"* ]]; then
-        ARGS="$ARGS --is_arabic"
-    fi
-
-    # Run the command
-    python "$SCRIPT" \
-        --data "$file" \
-        --out_dir "$OUT_DIR/$base" \
-        $ARGS
-
-    echo "Done with $file"
-done
+# All files are evaluated in one process, so models and tokenizers are loaded once.
+# --has_explanation / --is_arabic are set from the file paths ("explanation", "_ar"),
+# each file gets $OUT_DIR/<name>/metrics.json and a leaderboard is written to $OUT_DIR.
+# The pattern is quoted so compute_metrics.py expands it (one match still gets $OUT_DIR/<name>).
+python "$SCRIPT" \
+    --data "$DATA_DIR/*.jsonl" \
+    --out_dir "$OUT_DIR" \
+    --flags_from_name
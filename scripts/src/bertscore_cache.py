@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+bertscore_cache.py
+==================
+BERTScore with a persistent cache of reference token embeddings.
+
+Every result file of a task is scored against the same gold references, so
+the reference embeddings are computed once per model and stored on disk keyed
+by (model, num_layers, library versions, text hash). Candidates are embedded in length-sorted
+batches so each batch is only padded to its own longest sentence.
+
+Scoring reuses the greedy matching of `bert_score` (idf disabled, no baseline
+rescaling), so the results match `bert_score.score` for the same inputs.
+"""
+
+import hashlib
+import os
+from collections import OrderedDict, defaultdict
+from importlib import metadata
+from pathlib import Path
+
+import torch
+from bert_score.utils import bert_encode, get_model, get_tokenizer, greedy_cos_idf, padding, sent_encode
+from torch.nn.utils.rnn import pad_sequence
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("BERTSCORE_CACHE_DIR",
+                                        Path.home() / ".cache" / "memeintel" / "bertscore"))
+
+
+def library_tag(*names: str) -> str:
+    """Installed versions of the given packages, for cache namespaces (e.g. "torch2.3.1")."""
+    tags = []
+    for name in names:
+        try:
+            tags.append(f"{name}{metadata.version(name)}")
+        except metadata.PackageNotFoundError:
+            tags.append(f"{name}-none")
+    return "-".join(tags)
+
+
+class EmbeddingCache:
+    """Memory + disk LRU cache of per-sentence (embedding, idf) tensors for one model."""
+
+    def __init__(self, cache_dir: str | Path | None, namespace: str,
+                 max_disk_bytes: int = 5 * 1024 ** 3,
+                 max_memory_bytes: int = 1024 ** 3):
+        self.dir = Path(cache_dir) / namespace if cache_dir else None
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        if self.dir:
+            self.dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _nbytes(value) -> int:
+        return sum(t.element_size() * t.nelement() for t in value)
+
+    def _path(self, key: str) -> Path:
+        return self.dir / key[:2] / f"{key}.pt"
+
+    def _remember(self, key: str, value):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = value
+        self._memory_bytes += self._nbytes(value)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= self._nbytes(old)
+
+    def get(self, text: str):
+        key = self.key(text)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if not self.dir:
+            return None
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            value = torch.load(path, map_location="cpu")
+        except Exception:
+            # partially written or corrupt entry: drop it and recompute
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)  # mark as recently used for disk eviction
+        self._remember(key, value)
+        return value
+
+    def put(self, text: str, value):
+        key = self.key(text)
+        self._remember(key, value)
+        if not self.dir:
+            return
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_suffix(f".tmp{os.getpid()}")
+        torch.save(value, tmp)
+        os.replace(tmp, path)
+
+    def evict(self):
+        """Delete least recently used files until the disk cache fits in max_disk_bytes."""
+        if not self.dir:
+            return
+        files = [(p.stat(), p) for p in self.dir.glob("*/*.pt")]
+        total = sum(st.st_size for st, _ in files)
+        for st, path in sorted(files, key=lambda f: f[0].st_mtime):
+            if total <= self.max_disk_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= st.st_size
+
+
+class CachedBERTScorer:
+    """Holds one BERT model/tokenizer and scores candidate/reference pairs with it."""
+
+    def __init__(self, model_type: str, num_layers: int, device: str,
+                 cache_dir: str | Path | None = DEFAULT_CACHE_DIR,
+                 max_cache_bytes: int = 5 * 1024 ** 3):
+        self.model_type = model_type
+        self.num_layers = num_layers
+        self.device = device
+        self.tokenizer = get_tokenizer(model_type, False)
+        self.model = get_model(model_type, num_layers)
+        self.model.to(device)
+        # same weights bert_score.score uses when idf=False
+        self.idf_dict = defaultdict(lambda: 1.0)
+        self.idf_dict[self.tokenizer.sep_token_id] = 0
+        self.idf_dict[self.tokenizer.cls_token_id] = 0
+        # embeddings change with the model code, not just the weights
+        namespace = (f"{model_type.replace('/', '__')}-L{num_layers}-"
+                     f"{library_tag('torch', 'transformers', 'bert-score')}")
+        self.ref_cache = EmbeddingCache(cache_dir, namespace, max_disk_bytes=max_cache_bytes)
+
+    def _encode(self, token_ids: list[list[int]]) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        padded, _, mask = padding(token_ids, self.tokenizer.pad_token_id, dtype=torch.long)
+        padded_idf, _, _ = padding([[self.idf_dict[i] for i in ids] for ids in token_ids], 0, dtype=torch.float)
+        with torch.no_grad():
+            emb = bert_encode(self.model, padded.to(self.device), attention_mask=mask.to(self.device))
+        emb = emb.cpu()
+        # clone so cached entries do not keep the whole padded batch alive
+        return [(emb[i, :len(ids)].clone(), padded_idf[i, :len(ids)].clone())
+                for i, ids in enumerate(token_ids)]
+
+    def embed(self, sentences: list[str], batch_size: int, cache: EmbeddingCache | None = None,
+              token_ids: dict | None = None) -> dict:
+        """Return {sentence: (embedding, idf)}, encoding uncached sentences in length-sorted batches.
+
+        `token_ids` maps sentences to already computed `sent_encode` ids.
+        """
+        stats, missing = {}, []
+        for sen in dict.fromkeys(sentences):
+            hit = cache.get(sen) if cache else None
+            if hit is None:
+                missing.append(sen)
+            else:
+                stats[sen] = hit
+
+        token_ids = token_ids or {}
+        encoded = sorted(((sen, token_ids.get(sen) or sent_encode(self.tokenizer, sen)) for sen in missing),
+                         key=lambda x: len(x[1]), reverse=True)
+        for start in range(0, len(encoded), batch_size):
+            batch = encoded[start:start + batch_size]
+            for (sen, _), value in zip(batch, self._encode([ids for _, ids in batch])):
+                stats[sen] = value
+                if cache:
+                    cache.put(sen, value)
+        if cache and missing:
+            cache.evict()
+        return stats
+
+    def _pad(self, sentences: list[str], stats: dict):
+        emb, idf = zip(*(stats[s] for s in sentences))
+        lens = torch.tensor([e.size(0) for e in emb], dtype=torch.long)
+        emb_pad = pad_sequence([e.to(self.device) for e in emb], batch_first=True, padding_value=2.0)
+        idf_pad = pad_sequence([i.to(self.device) for i in idf], batch_first=True)
+        mask = (torch.arange(int(lens.max())).expand(len(lens), -1) < lens.unsqueeze(1)).to(self.device)
+        return emb_pad, mask, idf_pad
+
+    def score(self, cands: list[str], refs: list[str], batch_size: int = 32, token_ids: dict | None = None):
+        """Return (P, R, F) tensors, one value per (cand, ref) pair."""
+        stats = self.embed(cands, batch_size, token_ids=token_ids)
+        stats.update(self.embed(refs, batch_size, cache=self.ref_cache, token_ids=token_ids))
+
+        preds = []
+        with torch.no_grad():
+            for start in range(0, len(refs), batch_size):
+                ref_stats = self._pad(refs[start:start + batch_size], stats)
+                hyp_stats = self._pad(cands[start:start + batch_size], stats)
+                P, R, F = greedy_cos_idf(*ref_stats, *hyp_stats)
+                preds.append(torch.stack((P, R, F), dim=-1).cpu())
+        preds = torch.cat(preds, dim=0)
+        return preds[..., 0], preds[..., 1], preds[..., 2]
+
+
+_SCORERS = {}
+
+
+def get_scorer(model_type: str, num_layers: int, device: str,
+               cache_dir: str | Path | None = DEFAULT_CACHE_DIR,
+               max_cache_bytes: int = 5 * 1024 ** 3) -> CachedBERTScorer:
+    """Return a process-wide scorer so each model is loaded only once."""
+    key = (model_type, num_layers, device, str(cache_dir) if cache_dir else None)
+    if key not in _SCORERS:
+        _SCORERS[key] = CachedBERTScorer(model_type, num_layers, device,
+                                         cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
+    return _SCORERS[key]
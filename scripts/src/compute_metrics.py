@@ -12,13 +12,31 @@ It computes:
 - Classification metrics + saves confusion matrix plot
 - Explanation metrics (BERTScore, ROUGE, BLEU, METEOR) if applicable
 - Outputs results as metrics.json
+
+With --follow, a result file that is still being written by `swift infer`
+is tailed and running metrics are snapshotted to metrics.json; once the file
+stops growing the full batch evaluation is run on it.
+
+metrics.json records a fingerprint of the input file, flags, metric models
+and library versions; re-running on an unchanged file reuses the stored
+metrics unless --force is given.
+
+Several result files (or glob patterns) can be passed to --data. They are
+evaluated in one process so models, tokenizers and reference parses are
+loaded once, and a combined leaderboard.csv / leaderboard.json is written.
 """
 
 import argparse
+import glob
+import hashlib
 import json
 import os
 import random
 import re
+import time
+from collections import Counter
+from functools import lru_cache
+from importlib import metadata
 from pathlib import Path
 
 import matplotlib
@@ -28,16 +46,20 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 import torch
-from bert_score import score as bertscore
 from nltk import download as nltk_download
-from nltk.tokenize import word_tokenize
-from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
-from nltk.translate.meteor_score import meteor_score
-from rouge_score import rouge_scorer
-from sklearn.metrics import accuracy_score, confusion_matrix, f1_score, precision_score, recall_score
-from transformers import AutoTokenizer
 import evaluate as hf_evaluate
 
+from bertscore_cache import DEFAULT_CACHE_DIR, get_scorer
+from profiling import add_profile_args, run_profiled, stage
+from parallel_metrics import (bleu_meteor_pair, bleu_stats, corpus_bleu_from_stats, default_num_workers,
+                              init_meteor_worker, merge_bleu_stats, parallel_map, rouge_pair)
+from tokenized_corpus import DEFAULT_TOKEN_CACHE_DIR, TokenizedCorpus, bertscore_text, get_tokenize_fn
+
+try:
+    import pyarrow as pa
+    import pyarrow.json as pa_json
+except ImportError:  # optional, only speeds up loading result files
+    pa = None
 
 for pkg in ["punkt", "wordnet", "omw-1.4"]:
     nltk_download(pkg, quiet=True)
@@ -57,38 +79,184 @@ def extract_label_and_explanation(text: str) -> tuple[str | None, str | None]:
     return label, explanation
 
 
+# gold blocks repeat across every result file of a task, so parse each one once
+parse_reference = lru_cache(maxsize=None)(extract_label_and_explanation)
+
+
+def extract_label_and_explanation_columns(texts: pd.Series) -> pd.DataFrame:
+    """Vectorized extract_label_and_explanation over a column of string blocks."""
+    return pd.DataFrame({
+        "label": texts.str.extract(LABEL_RE.pattern, expand=False).str.strip(),
+        "explanation": texts.str.extract(EXPL_RE.pattern, expand=False).str.strip(),
+    }, index=texts.index)
+
+
+_REFERENCE_PARSES = pd.DataFrame(columns=["label", "explanation"], dtype=object)
+
+
+def parse_reference_columns(texts: pd.Series) -> pd.DataFrame:
+    """extract_label_and_explanation_columns for gold blocks, parsing each distinct block once per process."""
+    global _REFERENCE_PARSES
+    unique = pd.Series(texts.dropna().unique())
+    new = unique[~unique.isin(_REFERENCE_PARSES.index)]
+    if len(new):
+        parsed = extract_label_and_explanation_columns(new).set_index(new)
+        _REFERENCE_PARSES = pd.concat([_REFERENCE_PARSES, parsed])
+    return pd.DataFrame({col: texts.map(_REFERENCE_PARSES[col]) for col in _REFERENCE_PARSES.columns},
+                        index=texts.index)
+
+
 def read_jsonl_select_columns(file_path: str | Path, columns=("response", "labels")) -> pd.DataFrame:
-    df = pd.read_json(file_path, lines=True)
-    if not set(columns).issubset(df.columns):
+    """Load only `columns` of a JSONL file.
+
+    With pyarrow installed the JSON reader gets an explicit schema and drops
+    every other field (`messages`, `images`, ...) while parsing. Otherwise lines
+    are decoded one by one and only the selected fields are kept.
+    """
+    if pa is not None:
+        table = pa_json.read_json(
+            file_path,
+            read_options=pa_json.ReadOptions(block_size=64 << 20),
+            parse_options=pa_json.ParseOptions(
+                explicit_schema=pa.schema([(c, pa.string()) for c in columns]),
+                unexpected_field_behavior="ignore",
+            ),
+        )
+        df = table.to_pandas()
+    else:
+        rows = {c: [] for c in columns}
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                for c in columns:
+                    rows[c].append(record.get(c))
+        df = pd.DataFrame(rows, columns=list(columns))
+
+    if df.empty or df[list(columns)].isna().all().any():
         raise ValueError(f"Missing expected columns {columns} in file {file_path}")
     return df[list(columns)]
 
 
-def fix_invalid_labels(label: str | None, valid_labels: set) -> str:
-    """If label is invalid or missing, randomly assign from valid_labels."""
-    if label in valid_labels:
-        return label
-    return random.choice(list(valid_labels))
+def fix_invalid_labels(labels: pd.Series, valid_labels: set) -> pd.Series:
+    """Replace invalid or missing labels with a random choice from valid_labels."""
+    invalid = ~labels.isin(valid_labels)
+    replacements = pd.Series(
+        random.choices(sorted(valid_labels), k=int(invalid.sum())), index=labels.index[invalid], dtype=object
+    )
+    return labels.astype(object).where(~invalid, replacements)
+
+
+def normalize_non_to_not(label):
+    """Normalize labels since zero-shot models may produce variations like "non-" instead of "not-"."""
+    label = label.lower()
+    if isinstance(label, str) and label.startswith("non-"):
+        return "not-" + label[4:]
+    return label
+
+
+def normalize_labels(labels: pd.Series) -> pd.Series:
+    """Vectorized normalize_non_to_not."""
+    return labels.str.lower().str.replace(r"^non-", "not-", regex=True)
+
+
+def confusion_scores(cm: np.ndarray) -> dict[str, np.ndarray]:
+    """Accuracy and macro/weighted precision, recall and F1 from confusion matrices.
+
+    `cm` is one (L, L) matrix or a stack (..., L, L); rows are gold labels and
+    columns predictions. Matches sklearn with zero_division=0: macro averages
+    only cover labels that occur as gold or prediction.
+    """
+    cm = np.asarray(cm, dtype=np.float64)
+    tp = np.diagonal(cm, axis1=-2, axis2=-1)
+    support = cm.sum(axis=-1)
+    predicted = cm.sum(axis=-2)
+    total = support.sum(axis=-1)
+    present = (support + predicted) > 0
+    n_present = present.sum(axis=-1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(predicted > 0, tp / predicted, 0.0)
+        recall = np.where(support > 0, tp / support, 0.0)
+        f1 = np.where(present, 2 * tp / (support + predicted), 0.0)
+
+        def macro(values):
+            return np.where(n_present > 0, (values * present).sum(axis=-1) / n_present, 0.0)
+
+        def weighted(values):
+            return np.where(total > 0, (values * support).sum(axis=-1) / total, 0.0)
+
+        return {
+            "accuracy": np.where(total > 0, tp.sum(axis=-1) / total, 0.0),
+            "precision_macro": macro(precision),
+            "recall_macro": macro(recall),
+            "f1_macro": macro(f1),
+            "precision_weighted": weighted(precision),
+            "recall_weighted": weighted(recall),
+            "f1_weighted": weighted(f1),
+        }
+
+
+def classification_metrics_from_confusion(cm: np.ndarray) -> dict:
+    return {name: float(value) for name, value in confusion_scores(cm).items()}
+
+
+BOOTSTRAP_METRICS = ("accuracy", "f1_macro", "f1_weighted")
+
+
+def bootstrap_classification(true_codes: np.ndarray, pred_codes: np.ndarray, n_labels: int,
+                             n_resamples: int, seed: int = 0, ci: float = 0.95,
+                             max_batch_elems: int = 1 << 22) -> dict:
+    """Percentile bootstrap CIs for BOOTSTRAP_METRICS.
+
+    Resamples are drawn in batches: each batch becomes a stack of confusion
+    matrices through a single bincount, and all metrics are computed on the stack.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(true_codes)
+    cells = n_labels * n_labels
+    pair_codes = true_codes * n_labels + pred_codes
+    batch = max(1, max_batch_elems // max(n, 1))
+
+    samples = {name: [] for name in BOOTSTRAP_METRICS}
+    for start in range(0, n_resamples, batch):
+        b = min(batch, n_resamples - start)
+        idx = rng.integers(0, n, size=(b, n))
+        codes = pair_codes[idx] + (np.arange(b) * cells)[:, None]
+        cms = np.bincount(codes.ravel(), minlength=b * cells).reshape(b, n_labels, n_labels)
+        scores = confusion_scores(cms)
+        for name in BOOTSTRAP_METRICS:
+            samples[name].append(scores[name])
+
+    alpha = (1 - ci) / 2 * 100
+    result = {"bootstrap_resamples": n_resamples, "bootstrap_ci": ci}
+    for name, values in samples.items():
+        low, high = np.percentile(np.concatenate(values), [alpha, 100 - alpha])
+        result[f"{name}_ci_low"], result[f"{name}_ci_high"] = float(low), float(high)
+    return result
 
 
 def evaluate_classification(df: pd.DataFrame,
                             gold_col: str,
                             pred_col: str,
-                            cm_path: Path | None = None) -> dict:
-    y_true, y_pred = df[gold_col], df[pred_col]
-
-    metrics = {
-        "accuracy": accuracy_score(y_true, y_pred),
-        "precision_macro": precision_score(y_true, y_pred, average="macro", zero_division=0),
-        "recall_macro": recall_score(y_true, y_pred, average="macro", zero_division=0),
-        "f1_macro": f1_score(y_true, y_pred, average="macro", zero_division=0),
-        "precision_weighted": precision_score(y_true, y_pred, average="weighted", zero_division=0),
-        "recall_weighted": recall_score(y_true, y_pred, average="weighted", zero_division=0),
-        "f1_weighted": f1_score(y_true, y_pred, average="weighted", zero_division=0),
-    }
+                            cm_path: Path | None = None,
+                            bootstrap: int = 0,
+                            seed: int = 0) -> dict:
+    y_true = np.asarray(df[gold_col], dtype=object)
+    y_pred = np.asarray(df[pred_col], dtype=object)
+
+    # integer-code both columns against the sorted label union once, then build a single confusion matrix
+    labels, codes = np.unique(np.concatenate([y_true, y_pred]), return_inverse=True)
+    n_labels = len(labels)
+    true_codes, pred_codes = codes[:len(y_true)], codes[len(y_true):]
+    cm = np.bincount(true_codes * n_labels + pred_codes,
+                     minlength=n_labels * n_labels).reshape(n_labels, n_labels)
+
+    metrics = classification_metrics_from_confusion(cm)
+    if bootstrap:
+        metrics.update(bootstrap_classification(true_codes, pred_codes, n_labels, bootstrap, seed=seed))
 
-    cm = confusion_matrix(y_true, y_pred)
-    labels = sorted(y_true.unique())
     plt.figure(figsize=(8, 6))
     sns.heatmap(cm, annot=True, fmt='g', cmap='Blues',
                 xticklabels=labels, yticklabels=labels, cbar=False)
@@ -103,22 +271,30 @@ def evaluate_classification(df: pd.DataFrame,
     return metrics
 
 
-def compute_bertscore(preds, refs, arabic=False) -> dict:
+BERTSCORE_NUM_LAYERS = 12
+
+
+def bertscore_model_name(arabic=False) -> str:
+    return "aubmindlab/bert-base-arabertv2" if arabic else "bert-base-multilingual-uncased"
+
+
+def compute_bertscore(preds, refs, arabic=False, batch_size=32,
+                      cache_dir=DEFAULT_CACHE_DIR, cache_gb=5.0, corpus=None) -> dict:
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = "aubmindlab/bert-base-arabertv2" if arabic else "bert-base-multilingual-uncased"
-
-    preds = [" ".join(str(p).split()[:1024]) for p in preds]
-    refs = [" ".join(str(r).split()[:1024]) for r in refs]
-
-    P, R, F = bertscore(
-        cands=preds,
-        refs=refs,
-        model_type=model,
-        device=device,
-        num_layers=12,
-        batch_size=32,
-        verbose=False
-    )
+    model = bertscore_model_name(arabic)
+
+    token_ids = None
+    if corpus is not None:
+        pred_ids, ref_ids = corpus.tokens("bertscore", model)
+    preds = [bertscore_text(p) for p in preds]
+    refs = [bertscore_text(r) for r in refs]
+    if corpus is not None:
+        token_ids = dict(zip(preds + refs, pred_ids + ref_ids))
+
+    # reference embeddings are cached per model, so repeated runs only encode the candidates
+    scorer = get_scorer(model, num_layers=BERTSCORE_NUM_LAYERS, device=device,
+                        cache_dir=cache_dir or None, max_cache_bytes=int(cache_gb * 1024 ** 3))
+    P, R, F = scorer.score(preds, refs, batch_size=batch_size, token_ids=token_ids)
     return {
         "bertscore_precision": P.mean().item(),
         "bertscore_recall": R.mean().item(),
@@ -126,17 +302,15 @@ def compute_bertscore(preds, refs, arabic=False) -> dict:
     }
 
 
-def compute_rouge(preds, refs, arabic=False) -> dict:
-    model_name = "aubmindlab/bert-base-arabertv2" if arabic else "bert-base-uncased"
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    scorer = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], tokenizer=tokenizer)
-    r1, r2, rL = [], [], []
+def rouge_model_name(arabic=False) -> str:
+    return "aubmindlab/bert-base-arabertv2" if arabic else "bert-base-uncased"
+
 
-    for p, r in zip(preds, refs):
-        scores = scorer.score(r, p)
-        r1.append(scores["rouge1"].fmeasure)
-        r2.append(scores["rouge2"].fmeasure)
-        rL.append(scores["rougeL"].fmeasure)
+def compute_rouge(preds, refs, arabic=False, num_workers=1, corpus=None) -> dict:
+    model_name = rouge_model_name(arabic)
+    corpus = corpus or TokenizedCorpus(preds, refs, num_workers=num_workers)
+    scores = parallel_map(rouge_pair, corpus.pairs("rouge", model_name), num_workers=num_workers)
+    r1, r2, rL = zip(*scores) if scores else ((), (), ())
 
     return {
         "rouge1": float(np.mean(r1)),
@@ -145,87 +319,394 @@ def compute_rouge(preds, refs, arabic=False) -> dict:
     }
 
 
-def compute_bleu_meteor(preds, refs) -> dict:
-    smooth_fn = SmoothingFunction().method1
-    bleu = corpus_bleu([[word_tokenize(r)] for r in refs],
-                       [word_tokenize(p) for p in preds],
-                       smoothing_function=smooth_fn)
-    meteor_scores = [meteor_score([word_tokenize(r)], word_tokenize(p)) for r, p in zip(refs, preds)]
+def compute_bleu_meteor(preds, refs, num_workers=1, corpus=None) -> dict:
+    # BLEU and METEOR share one word_tokenize pass
+    corpus = corpus or TokenizedCorpus(preds, refs, num_workers=num_workers)
+    results = parallel_map(bleu_meteor_pair, corpus.pairs("word"), num_workers=num_workers,
+                           initializer=init_meteor_worker)
+    stats, meteor_scores = zip(*results) if results else ((), ())
+    # corpus BLEU from summed n-gram counts, same value as nltk's corpus_bleu with method1 smoothing
     return {
-        "bleu": bleu,
+        "bleu": corpus_bleu_from_stats(merge_bleu_stats(stats)),
         "meteor": float(np.mean(meteor_scores))
     }
 
 
-def evaluate_explanations(preds, refs, arabic=False) -> dict:
-    return {
-        **compute_bertscore(preds, refs, arabic=arabic),
-        **compute_rouge(preds, refs, arabic=arabic),
-        **compute_bleu_meteor(preds, refs)
+def evaluate_explanations(preds, refs, arabic=False, bertscore_kwargs=None, num_workers=1,
+                          token_cache_dir=DEFAULT_TOKEN_CACHE_DIR) -> dict:
+    # each text is tokenized once per tokenizer and shared by all metrics
+    corpus = TokenizedCorpus(preds, refs, cache_dir=token_cache_dir, num_workers=num_workers)
+    metrics = {}
+    with stage("bertscore"):
+        metrics.update(compute_bertscore(preds, refs, arabic=arabic, corpus=corpus, **(bertscore_kwargs or {})))
+    with stage("rouge"):
+        metrics.update(compute_rouge(preds, refs, arabic=arabic, num_workers=num_workers, corpus=corpus))
+    with stage("bleu + meteor"):
+        metrics.update(compute_bleu_meteor(preds, refs, num_workers=num_workers, corpus=corpus))
+    return metrics
+
+
+########## --follow: incremental evaluation of a result file that is still being written
+
+INVALID_LABEL = "<invalid>"
+
+
+class JsonlTailer:
+    """Returns the complete JSON lines appended to a file since the previous read."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.offset = 0
+        self.bad_lines = 0
+
+    def read_new(self) -> list[dict]:
+        if not self.path.exists():
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        end = chunk.rfind(b"\n")
+        if end < 0:
+            return []  # only a partially written line so far
+        self.offset += end + 1
+
+        records = []
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                self.bad_lines += 1
+        return records
+
+
+class StreamingMetrics:
+    """Running confusion counts and cheap explanation statistics (BLEU, ROUGE).
+
+    Predictions without a recognised label are counted as INVALID_LABEL instead
+    of being replaced at random, so malformed outputs show up early.
+    """
+
+    def __init__(self, has_explanation=False, arabic=False):
+        self.has_explanation = has_explanation
+        self.rouge_model = rouge_model_name(arabic)
+        self.counts = Counter()  # (gold label, raw predicted label) -> rows
+        self.gold_labels = set()
+        self.rows = 0
+        self.missing_gold = 0
+        self.bleu_total = merge_bleu_stats([])
+        self.rouge_sums = [0.0, 0.0, 0.0]
+
+    def update(self, record: dict):
+        gold, gold_expl = parse_reference(record.get("labels"))
+        pred, pred_expl = extract_label_and_explanation(record.get("response"))
+        if gold is None:
+            self.missing_gold += 1
+            return
+        self.rows += 1
+        self.gold_labels.add(gold)
+        self.counts[gold, pred] += 1
+
+        if self.has_explanation:
+            ref, hyp = gold_expl or "", pred_expl or ""
+            word_tokenize = get_tokenize_fn("word")
+            for i, v in enumerate(bleu_stats(word_tokenize(ref), word_tokenize(hyp))):
+                self.bleu_total[i] += v
+            rouge_tokenize = get_tokenize_fn("rouge", self.rouge_model)
+            for i, v in enumerate(rouge_pair((rouge_tokenize(ref), rouge_tokenize(hyp)))):
+                self.rouge_sums[i] += v
+
+    def snapshot(self) -> dict:
+        merged = Counter()
+        for (gold, pred), n in self.counts.items():
+            pred = normalize_non_to_not(pred) if pred in self.gold_labels else INVALID_LABEL
+            merged[normalize_non_to_not(gold), pred] += n
+
+        labels = sorted({g for g, _ in merged} | {p for _, p in merged})
+        index = {label: i for i, label in enumerate(labels)}
+        cm = np.zeros((len(labels), len(labels)), dtype=np.int64)
+        for (gold, pred), n in merged.items():
+            cm[index[gold], index[pred]] += n
+
+        metrics = classification_metrics_from_confusion(cm)
+        if self.has_explanation and self.rows:
+            metrics["bleu"] = corpus_bleu_from_stats(self.bleu_total)
+            metrics.update({k: v / self.rows for k, v in zip(("rouge1", "rouge2", "rougeL"), self.rouge_sums)})
+        metrics.update({
+            "streaming": True,
+            "rows": self.rows,
+            "invalid_labels": sum(n for (_, pred), n in merged.items() if pred == INVALID_LABEL),
+            "rows_without_gold_label": self.missing_gold,
+            "confusion_matrix": {"labels": labels, "counts": cm.tolist()},
+        })
+        return metrics
+
+
+def follow_file(data_path: Path, out_dir: Path, has_explanation: bool, is_arabic: bool, args) -> dict:
+    """Tail a growing result file, snapshotting running metrics, then run the full evaluation.
+
+    Stops when the file has not grown for --idle_timeout seconds (or on Ctrl-C).
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tailer = JsonlTailer(data_path)
+    stats = StreamingMetrics(has_explanation=has_explanation, arabic=is_arabic)
+    last_growth = last_snapshot = time.time()
+
+    print(f"Following {data_path} (Ctrl-C to stop and finalize)")
+    try:
+        while True:
+            records = tailer.read_new()
+            now = time.time()
+            if records:
+                for record in records:
+                    stats.update(record)
+                last_growth = now
+            if stats.rows and now - last_snapshot >= args.snapshot_interval:
+                snapshot = stats.snapshot()
+                snapshot["unparsable_lines"] = tailer.bad_lines
+                with open(out_dir / "metrics.json", "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f, indent=2, ensure_ascii=False)
+                print(f"[{time.strftime('%H:%M:%S')}] rows={snapshot['rows']} "
+                      f"invalid_labels={snapshot['invalid_labels']} "
+                      f"accuracy={snapshot['accuracy']:.4f} f1_macro={snapshot['f1_macro']:.4f}")
+                last_snapshot = now
+            if args.idle_timeout and now - last_growth >= args.idle_timeout:
+                print(f"No new lines for {args.idle_timeout}s, finalizing")
+                break
+            time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        print("Stopped following, finalizing")
+
+    # final numbers always come from the batch path over the complete file
+    return evaluate_file(data_path, out_dir, has_explanation, is_arabic, args)
+
+
+def expand_data_paths(patterns) -> list[Path]:
+    """Expand --data arguments (files or glob patterns) into a sorted, de-duplicated list of files."""
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            paths.append(pattern)
+    return [Path(p) for p in dict.fromkeys(paths)]
+
+
+def output_dir_for(path: Path, paths: list[Path], out_dir: Path, single_file: bool = False) -> Path:
+    """Single literal file -> out_dir itself; glob or several files -> out_dir/<path relative to their common parent>."""
+    if single_file:
+        return out_dir
+    root = Path(os.path.commonpath([str(p.resolve().parent) for p in paths]))
+    return out_dir / path.resolve().relative_to(root).with_suffix("")
+
+
+def load_predictions(data_path: str | Path) -> pd.DataFrame:
+    df = read_jsonl_select_columns(data_path)
+    df[["labels_label", "labels_explanation"]] = parse_reference_columns(df["labels"])
+    df[["response_label", "response_explanation"]] = extract_label_and_explanation_columns(df["response"])
+
+    valid_labels = set(df["labels_label"].dropna())
+    if not valid_labels:
+        raise ValueError("No valid gold labels found in dataset!")
+
+    df["response_label"] = fix_invalid_labels(df["response_label"], valid_labels)
+    df["labels_label"] = normalize_labels(df["labels_label"])
+    df["response_label"] = normalize_labels(df["response_label"])
+    return df
+
+
+########## memoization of unchanged result files
+
+METRIC_LIBRARIES = ("numpy", "pandas", "torch", "transformers", "bert-score", "rouge-score", "nltk")
+
+
+def file_sha256(path: str | Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def library_versions() -> dict:
+    versions = {}
+    for name in METRIC_LIBRARIES:
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def evaluation_fingerprint(data_path: Path, has_explanation: bool, is_arabic: bool, args) -> dict:
+    """Everything the metrics of one file depend on, plus a digest over it."""
+    inputs = {
+        "file_sha256": file_sha256(data_path),
+        "has_explanation": bool(has_explanation),
+        "is_arabic": bool(is_arabic),
+        "bootstrap": args.bootstrap,
+        "bootstrap_seed": args.bootstrap_seed,
+        "models": {
+            "bertscore": bertscore_model_name(is_arabic),
+            "bertscore_num_layers": BERTSCORE_NUM_LAYERS,
+            "rouge_tokenizer": rouge_model_name(is_arabic),
+        } if has_explanation else {},
+        "libraries": library_versions(),
     }
+    digest = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+    return {"digest": digest, **inputs}
+
+
+def load_cached_metrics(out_dir: Path, fingerprint: dict) -> dict | None:
+    """Return the stored metrics if out_dir holds results for the same fingerprint."""
+    metrics_path = out_dir / "metrics.json"
+    if not metrics_path.exists() or not (out_dir / "confusion_matrix.png").exists():
+        return None
+    try:
+        with open(metrics_path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+    except json.JSONDecodeError:
+        return None
+    if stored.get("fingerprint", {}).get("digest") != fingerprint["digest"]:
+        return None
+    stored.pop("fingerprint")
+    return stored
+
+
+def evaluate_file(data_path: Path, out_dir: Path, has_explanation: bool, is_arabic: bool, args) -> dict:
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with stage("fingerprint"):
+        fingerprint = evaluation_fingerprint(data_path, has_explanation, is_arabic, args)
+    if not args.force:
+        cached = load_cached_metrics(out_dir, fingerprint)
+        if cached is not None:
+            print(f"{data_path} is unchanged since the last run, reusing {out_dir / 'metrics.json'}")
+            return cached
+
+    with stage("load + parse"):
+        df = load_predictions(data_path)
+    with stage("classification"):
+        metrics = evaluate_classification(
+            df, gold_col="labels_label", pred_col="response_label",
+            cm_path=out_dir / "confusion_matrix.png",
+            bootstrap=args.bootstrap, seed=args.bootstrap_seed
+        )
+
+    if has_explanation:
+        preds = df["response_explanation"].fillna("").tolist()
+        refs = df["labels_explanation"].fillna("").tolist()
+        bertscore_kwargs = {
+            "batch_size": args.bertscore_batch_size,
+            "cache_dir": args.bertscore_cache_dir,
+            "cache_gb": args.bertscore_cache_gb,
+        }
+        metrics.update(evaluate_explanations(preds, refs, arabic=is_arabic,
+                                             bertscore_kwargs=bertscore_kwargs,
+                                             num_workers=args.num_workers,
+                                             token_cache_dir=args.token_cache_dir))
+
+    # save
+    with open(out_dir / "metrics.json", "w", encoding="utf-8") as f:
+        json.dump({**metrics, "fingerprint": fingerprint}, f, indent=2, ensure_ascii=False)
+    return metrics
+
+
+def write_leaderboard(rows: list[dict], out_dir: Path):
+    """Write one row per evaluated file, best macro-F1 first."""
+    board = pd.DataFrame(rows).sort_values("f1_macro", ascending=False)
+    board.to_csv(out_dir / "leaderboard.csv", index=False)
+    with open(out_dir / "leaderboard.json", "w", encoding="utf-8") as f:
+        json.dump(board.to_dict(orient="records"), f, indent=2, ensure_ascii=False)
+    print(f"Leaderboard saved to {out_dir / 'leaderboard.csv'} and {out_dir / 'leaderboard.json'}")
 
 
 def cli():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--data", required=True, help="Path to JSONL dataset file")
+    parser.add_argument("--data", required=True, nargs="+",
+                        help="Path(s) or glob pattern(s) of JSONL result files, e.g. 'result/**/*.jsonl'")
     parser.add_argument("--has_explanation", action="store_true", help="If present, compute explanation metrics")
     parser.add_argument("--is_arabic", action="store_true", help="Use AraBERT models/tokenizers")
+    parser.add_argument("--flags_from_name", action="store_true",
+                        help="Also enable --has_explanation for paths containing 'explanation' "
+                             "and --is_arabic for paths containing '_ar' (like evaluate.sh)")
     parser.add_argument("--out_dir", required=True, help="Directory to save metrics.json & confusion_matrix.png")
+    parser.add_argument("--bertscore_batch_size", type=int, default=32, help="Sentences per BERTScore batch")
+    parser.add_argument("--bertscore_cache_dir", default=str(DEFAULT_CACHE_DIR),
+                        help="Directory for cached reference embeddings ('' disables the disk cache)")
+    parser.add_argument("--bertscore_cache_gb", type=float, default=5.0,
+                        help="Disk budget of the embedding cache; least recently used entries are evicted")
+    parser.add_argument("--token_cache_dir", default=str(DEFAULT_TOKEN_CACHE_DIR),
+                        help="Directory for cached reference tokenizations ('' disables the disk cache)")
+    parser.add_argument("--num_workers", type=int, default=default_num_workers(),
+                        help="Processes for ROUGE/BLEU/METEOR (1 = serial)")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute metrics even if metrics.json matches the input fingerprint")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Number of bootstrap resamples for 95%% CIs of accuracy and macro/weighted F1 (0 = off)")
+    parser.add_argument("--bootstrap_seed", type=int, default=0, help="Random seed for --bootstrap")
+    parser.add_argument("--follow", action="store_true",
+                        help="Tail a result file that is still being written and snapshot running metrics")
+    parser.add_argument("--poll_interval", type=float, default=2.0, help="--follow: seconds between file checks")
+    parser.add_argument("--snapshot_interval", type=float, default=30.0,
+                        help="--follow: seconds between metrics.json snapshots")
+    parser.add_argument("--idle_timeout", type=float, default=600.0,
+                        help="--follow: finalize after this many seconds without new lines (0 = wait for Ctrl-C)")
+    add_profile_args(parser)
     return parser.parse_args()
 
 
+def file_flags(path: Path, args) -> tuple[bool, bool]:
+    """(has_explanation, is_arabic) for one result file, from the flags or, with --flags_from_name, its path."""
+    has_explanation = args.has_explanation or (args.flags_from_name and "explanation" in str(path))
+    is_arabic = args.is_arabic or (args.flags_from_name and "_ar" in str(path))
+    return has_explanation, is_arabic
+
+
 def main():
     args = cli()
     out_dir = Path(args.out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    df = read_jsonl_select_columns(args.data)
-    df[["labels_label", "labels_explanation"]] = pd.DataFrame(
-        df["labels"].apply(extract_label_and_explanation).tolist(), index=df.index
-    )
-    df[["response_label", "response_explanation"]] = pd.DataFrame(
-        df["response"].apply(extract_label_and_explanation).tolist(), index=df.index
-    )
-
-    valid_labels = set(df["labels_label"].dropna())
-    if not valid_labels:
-        raise ValueError("No valid gold labels found in dataset!")
-
-    df["response_label"] = df["response_label"].apply(lambda x: fix_invalid_labels(x, valid_labels))
-
-    ########## to normalize labels since zero-shot models may produce variations like "non-" instead of "not-"
-    def normalize_non_to_not(label):
-        label = label.lower()
-        if isinstance(label, str) and label.startswith("non-"):
-            
-            label =  "not-" + label[4:]
-            #print(label)
-            return label
-            
-        return label
-
-    df["labels_label"] = df["labels_label"].apply(normalize_non_to_not)
-    df["response_label"] = df["response_label"].apply(normalize_non_to_not)
-    ############
-    metrics = evaluate_classification(
-        df, gold_col="labels_label", pred_col="response_label",
-        cm_path=out_dir / "confusion_matrix.png"
-    )
-
-    if args.has_explanation:
-        preds = df["response_explanation"].fillna("").tolist()
-        refs = df["labels_explanation"].fillna("").tolist()
-        metrics.update(evaluate_explanations(preds, refs, arabic=args.is_arabic))
-
-    # save
-    with open(out_dir / "metrics.json", "w", encoding="utf-8") as f:
-        json.dump(metrics, f, indent=2, ensure_ascii=False)
-
-    print("\nEvaluation complete")
-    print(json.dumps(metrics, indent=2, ensure_ascii=False))
-    print(f"Metrics saved to {out_dir / 'metrics.json'}")
-    print(f"Confusion matrix saved to {out_dir / 'confusion_matrix.png'}")
+    if args.follow:
+        if len(args.data) != 1 or glob.has_magic(args.data[0]):
+            raise ValueError("--follow takes exactly one result file")
+        path = Path(args.data[0])
+        metrics = follow_file(path, out_dir, *file_flags(path, args), args)
+        print("\nEvaluation complete")
+        print(json.dumps(metrics, indent=2, ensure_ascii=False))
+        print(f"Metrics saved to {out_dir / 'metrics.json'}")
+        return
+
+    paths = expand_data_paths(args.data)
+    if not paths:
+        raise ValueError(f"No result files match {args.data}")
+
+    # a glob gets per-file subdirectories even when it matches a single file
+    single_file = len(args.data) == 1 and not glob.has_magic(args.data[0])
+    rows = []
+    for path in paths:
+        has_explanation, is_arabic = file_flags(path, args)
+        file_out_dir = output_dir_for(path, paths, out_dir, single_file)
+
+        print(f"\nProcessing {path} ...")
+        try:
+            metrics = evaluate_file(path, file_out_dir, has_explanation, is_arabic, args)
+        except Exception as e:
+            if len(paths) == 1:
+                raise
+            print(f"Error evaluating {path}: {e}")
+            continue
+
+        print("\nEvaluation complete")
+        print(json.dumps(metrics, indent=2, ensure_ascii=False))
+        print(f"Metrics saved to {file_out_dir / 'metrics.json'}")
+        print(f"Confusion matrix saved to {file_out_dir / 'confusion_matrix.png'}")
+        rows.append({"file": str(path), **metrics})
+
+    if len(paths) > 1 and rows:
+        write_leaderboard(rows, out_dir)
 
 
 if __name__ == "__main__":
-    main()
+    run_profiled(main)
@@ -5,6 +5,8 @@ import json
 import pandas as pd
 from typing import List, Dict
 
+from profiling import add_profile_args, run_profiled, stage
+
 def format_data(
     df: pd.DataFrame,
     instruction: str,
@@ -55,11 +57,12 @@ def load_datasets(data_base_path: str, suffixes: List[str]) -> Dict[str, pd.Data
         for split, suffix in zip(["train", "test", "dev"], suffixes)
     }
 
-if __name__ == "__main__":
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_base_path", type=str, required=True)
     parser.add_argument("--output_dir", type=str, required=True)
     parser.add_argument("--dataset_type", type=str, choices=["armeme", "hateful"], required=True)
+    add_profile_args(parser)
 
     args = parser.parse_args()
     suffixes = {
@@ -67,7 +70,8 @@ if __name__ == "__main__":
         "hateful": ["", "", ""]
     }[args.dataset_type]
 
-    dataset = load_datasets(args.data_base_path, suffixes)
+    with stage("dataset load"):
+        dataset = load_datasets(args.data_base_path, suffixes)
 
     if args.dataset_type == "armeme":
         SYS_PROMPT = "You are an expert social media image analyzer specializing in identifying propaganda in Arabic contexts."
@@ -107,17 +111,24 @@ if __name__ == "__main__":
 
     for split in ["train", "test", "dev"]:
         # classification
-        formatted = format_data(dataset[split], INSTRUCTION_CLS, SYS_PROMPT, "classification", args.data_base_path)
-        save_jsonl(formatted, os.path.join(args.output_dir, "classification", f"{split}.jsonl"))
+        with stage("format"):
+            formatted = format_data(dataset[split], INSTRUCTION_CLS, SYS_PROMPT, "classification", args.data_base_path)
+        with stage("serialize"):
+            save_jsonl(formatted, os.path.join(args.output_dir, "classification", f"{split}.jsonl"))
 
         # explanation
         for exp_key, instruction in INSTRUCTIONS_EXP.items():
-            formatted = format_data(
-                dataset[split],
-                instruction,
-                SYS_PROMPT,
-                "explanation",
-                args.data_base_path,
-                explanation_column=exp_key
-            )
-            save_jsonl(formatted, os.path.join(args.output_dir, "explanation", exp_key, f"{split}.jsonl"))
+            with stage("format"):
+                formatted = format_data(
+                    dataset[split],
+                    instruction,
+                    SYS_PROMPT,
+                    "explanation",
+                    args.data_base_path,
+                    explanation_column=exp_key
+                )
+            with stage("serialize"):
+                save_jsonl(formatted, os.path.join(args.output_dir, "explanation", exp_key, f"{split}.jsonl"))
+
+if __name__ == "__main__":
+    run_profiled(main)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+parallel_metrics.py
+===================
+Per-pair explanation metrics (ROUGE, BLEU statistics, METEOR) executed in a
+process pool.
+
+Pairs arrive already tokenized (see tokenized_corpus.py). Workers load
+WordNet once in the pool initializer and then score chunks of
+(reference, prediction) pairs. Results come back in input order, and corpus
+BLEU is computed from the summed n-gram counts, so the output is identical to
+scoring the pairs serially.
+"""
+
+import math
+import multiprocessing as mp
+import os
+from collections import Counter
+
+from nltk.corpus import wordnet
+from nltk.translate.bleu_score import brevity_penalty
+from nltk.translate.meteor_score import meteor_score
+from nltk.util import ngrams
+from rouge_score.rouge_scorer import _create_ngrams, _score_lcs, _score_ngrams
+
+BLEU_MAX_N = 4
+
+
+def default_num_workers() -> int:
+    return os.cpu_count() or 1
+
+
+def parallel_map(func, items, num_workers=1, initializer=None, initargs=(), chunk_size=None) -> list:
+    """Apply `func` to `items` and return the results in input order.
+
+    With num_workers <= 1 everything runs in the current process, otherwise
+    items are sent to a process pool in chunks.
+    """
+    items = list(items)
+    if num_workers <= 1 or len(items) < 2:
+        if initializer:
+            initializer(*initargs)
+        return [func(x) for x in items]
+
+    # HF fast tokenizers must not use their own thread pool inside forked workers
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    chunk_size = chunk_size or max(1, math.ceil(len(items) / (num_workers * 4)))
+    with mp.Pool(num_workers, initializer=initializer, initargs=initargs) as pool:
+        return pool.map(func, items, chunksize=chunk_size)
+
+
+########## ROUGE
+
+def rouge_pair(pair) -> tuple[float, float, float]:
+    """rouge1/rouge2/rougeL F-measures, as RougeScorer.score computes them from tokens."""
+    ref_tokens, pred_tokens = pair
+    r1 = _score_ngrams(_create_ngrams(ref_tokens, 1), _create_ngrams(pred_tokens, 1))
+    r2 = _score_ngrams(_create_ngrams(ref_tokens, 2), _create_ngrams(pred_tokens, 2))
+    rL = _score_lcs(ref_tokens, pred_tokens)
+    return r1.fmeasure, r2.fmeasure, rL.fmeasure
+
+
+########## BLEU / METEOR
+
+def init_meteor_worker():
+    wordnet.ensure_loaded()
+
+
+def bleu_stats(ref_tokens: list[str], hyp_tokens: list[str]) -> tuple[int, ...]:
+    """Sufficient statistics of one pair: (hyp_len, ref_len, num_1..num_N, den_1..den_N).
+
+    Counts follow nltk's modified_precision for a single reference.
+    """
+    nums, dens = [], []
+    for n in range(1, BLEU_MAX_N + 1):
+        hyp_counts = Counter(ngrams(hyp_tokens, n)) if len(hyp_tokens) >= n else Counter()
+        ref_counts = Counter(ngrams(ref_tokens, n)) if len(ref_tokens) >= n else Counter()
+        nums.append(sum(min(count, ref_counts[ng]) for ng, count in hyp_counts.items()))
+        dens.append(max(1, sum(hyp_counts.values())))
+    return (len(hyp_tokens), len(ref_tokens), *nums, *dens)
+
+
+def merge_bleu_stats(stats) -> list[int]:
+    total = [0] * (2 + 2 * BLEU_MAX_N)
+    for s in stats:
+        for i, v in enumerate(s):
+            total[i] += v
+    return total
+
+
+def corpus_bleu_from_stats(total, epsilon=0.1) -> float:
+    """Corpus BLEU from merged statistics.
+
+    Equivalent to nltk's corpus_bleu with uniform 4-gram weights and
+    SmoothingFunction().method1 (epsilon added to zero-count precisions).
+    """
+    hyp_len, ref_len = total[0], total[1]
+    nums, dens = total[2:2 + BLEU_MAX_N], total[2 + BLEU_MAX_N:]
+    if nums[0] == 0:
+        return 0.0
+    bp = brevity_penalty(ref_len, hyp_len)
+    p_n = [(num + epsilon) / den if num == 0 else num / den for num, den in zip(nums, dens)]
+    weight = 1 / BLEU_MAX_N
+    return bp * math.exp(math.fsum(weight * math.log(p) for p in p_n if p > 0))
+
+
+def bleu_meteor_pair(pair) -> tuple[tuple[int, ...], float]:
+    ref_tokens, pred_tokens = pair
+    return bleu_stats(ref_tokens, pred_tokens), meteor_score([ref_tokens], pred_tokens)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+profiling.py
+============
+--profile support shared by the pipeline CLIs.
+
+`run_profiled(main)` runs a script's entry point under a profiler when
+--profile is on the command line: pyinstrument (sampling) if it is installed,
+cProfile otherwise. The profile is written to --profile_out and the top
+--profile_top hotspots (cProfile) or the call tree (pyinstrument) are
+printed. Named stage timers (`with stage("parse"): ...`) are always
+collected and their totals are printed with the profile.
+
+The scripts in scripts/batch_infer/ import this module by adding
+scripts/src/ to sys.path.
+"""
+
+import argparse
+import cProfile
+import importlib.util
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILERS = ("auto", "cprofile", "pyinstrument")
+
+
+class StageTimers:
+    """Accumulated wall time and call count per named stage (thread-safe)."""
+
+    def __init__(self):
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                total, calls = self.totals.get(name, (0.0, 0))
+                self.totals[name] = (total + elapsed, calls + 1)
+
+    def report(self) -> str:
+        wall = time.perf_counter() - self.started
+        lines = [f"Stage timers (wall time {wall:.2f}s):",
+                 f"  {'stage':<24} {'calls':>8} {'total s':>10} {'mean ms':>10} {'% wall':>7}"]
+        for name, (total, calls) in sorted(self.totals.items(), key=lambda x: -x[1][0]):
+            lines.append(f"  {name:<24} {calls:>8} {total:>10.3f} {1000 * total / calls:>10.2f} "
+                         f"{100 * total / wall if wall else 0:>6.1f}%")
+        return "\n".join(lines)
+
+
+timers = StageTimers()
+stage = timers.stage
+
+
+def add_profile_args(parser: argparse.ArgumentParser):
+    """Add --profile, --profile_out and --profile_top to a script's parser."""
+    parser.add_argument("--profile", nargs="?", const="auto", choices=PROFILERS,
+                        help="Profile the run (auto = pyinstrument if installed, else cProfile) "
+                             "and print hotspots and stage timings")
+    parser.add_argument("--profile_out",
+                        help="Profile output file (default: <script>.prof, or <script>.html with pyinstrument)")
+    parser.add_argument("--profile_top", type=int, default=25,
+                        help="Number of hotspots to print (cProfile only; pyinstrument prints its call tree)")
+    return parser
+
+
+def run_profiled(main):
+    """Call main(), under a profiler if --profile is given on the command line."""
+    parser = add_profile_args(argparse.ArgumentParser(add_help=False))
+    args, _ = parser.parse_known_args()
+    if not args.profile:
+        return main()
+
+    profiler = args.profile
+    if profiler == "auto":
+        profiler = "pyinstrument" if importlib.util.find_spec("pyinstrument") else "cprofile"
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    out = args.profile_out or f"{script}.{'html' if profiler == 'pyinstrument' else 'prof'}"
+
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        sampler = Profiler()
+        sampler.start()
+        try:
+            return main()
+        finally:
+            sampler.stop()
+            print(sampler.output_text(unicode=True, color=False))
+            sampler.write_html(out)
+            print(f"Profile saved to {out}")
+            print(timers.report())
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        return main()
+    finally:
+        profile.disable()
+        profile.dump_stats(out)
+        print(f"\nTop {args.profile_top} functions by own time:")
+        pstats.Stats(profile).sort_stats("tottime").print_stats(args.profile_top)
+        print(f"Profile saved to {out} (view with: python -m pstats {out}, or snakeviz)")
+        print(timers.report())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+tokenized_corpus.py
+===================
+Shared tokenization stage for the explanation metrics.
+
+Every text is tokenized once per tokenizer and reused by all metrics:
+- "word"      : nltk word_tokenize (BLEU, METEOR)
+- "rouge"     : HF tokenizer .tokenize() (ROUGE)
+- "bertscore" : bert_score token ids (BERTScore)
+
+Reference tokenizations are also stored on disk keyed by tokenizer, library
+versions and text hash, because the same gold references are scored against
+many result files.
+"""
+
+import hashlib
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from bert_score.utils import get_tokenizer, sent_encode
+from nltk.tokenize import word_tokenize
+from transformers import AutoTokenizer
+
+from bertscore_cache import library_tag
+from parallel_metrics import parallel_map
+from profiling import stage
+
+DEFAULT_TOKEN_CACHE_DIR = Path(os.environ.get("TOKEN_CACHE_DIR",
+                                              Path.home() / ".cache" / "memeintel" / "tokens"))
+
+BERTSCORE_MAX_WORDS = 1024
+
+# packages whose upgrades can change the tokens of each tokenizer kind
+TOKENIZER_LIBRARIES = {
+    "word": ("nltk",),
+    "rouge": ("transformers", "tokenizers"),
+    "bertscore": ("bert-score", "transformers", "tokenizers"),
+}
+
+
+def bertscore_text(text) -> str:
+    """Text as fed to BERTScore (first 1024 whitespace-separated words)."""
+    return " ".join(str(text).split()[:BERTSCORE_MAX_WORDS])
+
+
+@lru_cache(maxsize=None)
+def get_tokenize_fn(kind: str, model_name: str | None = None):
+    """Return a text -> tokens function; tokenizers are loaded once per process."""
+    if kind == "word":
+        return word_tokenize
+    if kind == "rouge":
+        return AutoTokenizer.from_pretrained(model_name).tokenize
+    if kind == "bertscore":
+        tokenizer = get_tokenizer(model_name, False)
+        return lambda text: sent_encode(tokenizer, bertscore_text(text))
+    raise ValueError(f"Unknown tokenizer kind: {kind}")
+
+
+# per-process tokenizer, set by the pool initializer
+_ACTIVE = {}
+
+
+def init_tokenize_worker(kind: str, model_name: str | None):
+    _ACTIVE["tokenize"] = get_tokenize_fn(kind, model_name)
+
+
+def tokenize_text(text: str) -> list:
+    return list(_ACTIVE["tokenize"](text))
+
+
+class TokenCache:
+    """Append-only JSONL store mapping text hash -> tokens for one tokenizer."""
+
+    def __init__(self, cache_dir: str | Path | None, namespace: str):
+        self.path = Path(cache_dir) / f"{namespace}.jsonl" if cache_dir else None
+        self.entries = {}
+        if self.path and self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # truncated line from an interrupted run
+                    self.entries[entry["h"]] = entry["t"]
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def get(self, text: str):
+        return self.entries.get(self.key(text))
+
+    def update(self, tokenized: dict):
+        new = {self.key(text): tokens for text, tokens in tokenized.items()}
+        new = {h: t for h, t in new.items() if h not in self.entries}
+        if not new:
+            return
+        self.entries.update(new)
+        if self.path:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                for h, t in new.items():
+                    f.write(json.dumps({"h": h, "t": t}, ensure_ascii=False) + "\n")
+
+
+_TOKEN_CACHES = {}
+
+
+def get_token_cache(cache_dir: str | Path | None, namespace: str) -> TokenCache:
+    """Return a process-wide TokenCache so each cache file is read once."""
+    key = (str(cache_dir) if cache_dir else None, namespace)
+    if key not in _TOKEN_CACHES:
+        _TOKEN_CACHES[key] = TokenCache(cache_dir, namespace)
+    return _TOKEN_CACHES[key]
+
+
+class TokenizedCorpus:
+    """Predictions and references tokenized lazily, once per tokenizer."""
+
+    def __init__(self, preds, refs, cache_dir: str | Path | None = DEFAULT_TOKEN_CACHE_DIR, num_workers=1):
+        self.preds = list(preds)
+        self.refs = list(refs)
+        self.cache_dir = cache_dir or None
+        self.num_workers = num_workers
+        self._tokens = {}
+
+    def tokens(self, kind: str, model_name: str | None = None) -> tuple[list, list]:
+        """Return (pred_tokens, ref_tokens) for the given tokenizer."""
+        key = (kind, model_name)
+        if key not in self._tokens:
+            self._tokens[key] = self._tokenize(kind, model_name)
+        return self._tokens[key]
+
+    def pairs(self, kind: str, model_name: str | None = None) -> list[tuple[list, list]]:
+        """Return (ref_tokens, pred_tokens) pairs in dataset order."""
+        pred_tokens, ref_tokens = self.tokens(kind, model_name)
+        return list(zip(ref_tokens, pred_tokens))
+
+    def _tokenize(self, kind: str, model_name: str | None) -> tuple[list, list]:
+        namespace = kind if model_name is None else f"{kind}-{model_name.replace('/', '__')}"
+        namespace = f"{namespace}-{library_tag(*TOKENIZER_LIBRARIES[kind])}"
+        cache = get_token_cache(self.cache_dir, namespace)
+
+        done = {}
+        for ref in dict.fromkeys(self.refs):
+            hit = cache.get(ref)
+            if hit is not None:
+                done[ref] = hit
+
+        todo = [t for t in dict.fromkeys(self.refs + self.preds) if t not in done]
+        with stage(f"tokenize ({kind})"):
+            if todo:
+                # load in this process so forked pool workers inherit the tokenizer
+                get_tokenize_fn(kind, model_name)
+            tokenized = parallel_map(tokenize_text, todo, num_workers=self.num_workers,
+                                     initializer=init_tokenize_worker, initargs=(kind, model_name))
+        done.update(zip(todo, tokenized))
+        cache.update({ref: done[ref] for ref in dict.fromkeys(self.refs)})
+        return [done[p] for p in self.preds], [done[r] for r in self.refs]